@@ -0,0 +1,187 @@
+import gzip
+import json
+import os
+import re
+import shutil
+import threading
+import time
+
+from api_cache import CACHE_DIR, endpoint_family
+
+# Directory holding a sub-directory per kind of run (full, hot, shard-0-of-4, ...) and
+# in it one sub-directory of compressed JSON Lines per run
+ARCHIVE_DIR = os.environ.get("PUIG_ARCHIVE_DIR", os.path.join(CACHE_DIR, "archive"))
+# Set PUIG_ARCHIVE=0 to stop archiving raw responses
+ARCHIVE_ENABLED = os.environ.get("PUIG_ARCHIVE", "1") != "0"
+# Number of complete runs kept per kind, older ones are removed when a run completes
+ARCHIVE_KEEP = int(os.environ.get("PUIG_ARCHIVE_KEEP", "3"))
+# File written in a run's directory once all its responses are archived
+COMPLETE_MARKER = "complete"
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# RAW RESPONSE ARCHIVE
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def _file_name(family):
+    """archive file of an endpoint family, e.g. references_code_colour.jsonl.gz"""
+    return re.sub(r"[^A-Za-z0-9]+", "_", family).strip("_") + ".jsonl.gz"
+
+
+def _complete(path):
+    return os.path.exists(os.path.join(path, COMPLETE_MARKER))
+
+
+def _running(run_id):
+    """True if the process archiving a run may still be writing it"""
+    try:
+        os.kill(int(run_id.rsplit("-", 1)[-1]), 0)
+    except ProcessLookupError:
+        return False
+    except (ValueError, OSError):
+        pass
+    return True
+
+
+def runs(kind, directory=None, complete=True):
+    """archived run ids of a kind, oldest first
+
+    Args:
+        kind (string): kind of run, e.g. full or hot
+        directory (string): optional argument. Defaults to ARCHIVE_DIR
+        complete (boolean): optional argument. Set to False to also list runs still being written or interrupted
+    """
+    directory = os.path.join(directory or ARCHIVE_DIR, kind)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        name for name in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, name)) and (not complete or _complete(os.path.join(directory, name)))
+    )
+
+
+def prune(kind, directory=None):
+    """keep the newest ARCHIVE_KEEP complete runs of a kind, and as many failed or interrupted ones
+
+    Runs still being written are never removed.
+    """
+    directory = directory or ARCHIVE_DIR
+    complete = runs(kind, directory)
+    failed = [run_id for run_id in runs(kind, directory, complete=False)
+              if run_id not in complete and not _running(run_id)]
+    for run_id in complete[:max(0, len(complete) - ARCHIVE_KEEP)] + failed[:max(0, len(failed) - ARCHIVE_KEEP)]:
+        shutil.rmtree(os.path.join(directory, kind, run_id), ignore_errors=True)
+
+
+class Archive:
+    """Writer of every raw 200 response of a run, one gzip JSON Lines file per endpoint family.
+
+    Each line holds {"url": ..., "body": ...} with the body exactly as the API sent it.
+    Closing the archive marks the run complete and prunes the runs of the same kind, so
+    a hot run never removes the archive of a full run and no run removes one still
+    being written.
+
+    Args:
+        kind (string): optional argument. Kind of run, e.g. full, hot or shard-0-of-4
+        directory (string): optional argument. Defaults to ARCHIVE_DIR
+    """
+
+    def __init__(self, kind="adhoc", directory=None):
+        self.kind = kind
+        self.directory = directory or ARCHIVE_DIR
+        # the pid keeps runs started in the same second apart, and tells whether the run is still going
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.path = os.path.join(self.directory, kind, self.run_id)
+        os.makedirs(self.path, exist_ok=True)
+        self._files = {}
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def write(self, url, raw):
+        """archive a response
+
+        Args:
+            url (string): url that was requested
+            raw (bytes): response body, valid json
+        """
+        # newlines can only be whitespace between json tokens, so the body fits on one line
+        body = raw.replace(b"\r", b" ").replace(b"\n", b" ").decode("utf-8")
+        line = '{"url": ' + json.dumps(url) + ', "body": ' + body + "}\n"
+        name = _file_name(endpoint_family(url))
+        with self._lock:
+            if name not in self._files:
+                self._files[name] = gzip.open(os.path.join(self.path, name), "at", encoding="utf-8")
+            self._files[name].write(line)
+            self.count += 1
+
+    def close(self, complete=True):
+        """close the files, marking the run complete unless it failed
+
+        Args:
+            complete (boolean): optional argument. Set to False if the run failed
+        """
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files = {}
+        if complete:
+            open(os.path.join(self.path, COMPLETE_MARKER), "w").close()
+        prune(self.kind, self.directory)
+        print(f"Archived {self.count} responses to {self.path}")
+
+
+class Replay:
+    """Responses of an archived run, served instead of requesting the API.
+
+    Args:
+        run_id (string): optional argument. Archived run to replay, 'latest' (default) for the newest
+            complete run of kind
+        kind (string): optional argument. Kind of run 'latest' is looked up in, defaults to full
+        directory (string): optional argument. Defaults to ARCHIVE_DIR
+    """
+
+    def __init__(self, run_id="latest", kind="full", directory=None):
+        directory = directory or ARCHIVE_DIR
+        if run_id == "latest":
+            archived = runs(kind, directory)
+            if not archived:
+                raise FileNotFoundError(f"No complete {kind} run archived in {directory}")
+            self.path = os.path.join(directory, kind, archived[-1])
+        else:
+            # a run id given explicitly may be of any kind, or interrupted
+            paths = [os.path.join(directory, name, run_id) for name in sorted(os.listdir(directory))] \
+                if os.path.isdir(directory) else []
+            paths = [path for path in paths if os.path.isdir(path)]
+            if not paths:
+                raise FileNotFoundError(f"No archived run {run_id} in {directory}")
+            self.path = paths[0]
+        # raw line by url, decoded on lookup; a url archived twice keeps its last response
+        self._lines = {}
+        for name in sorted(os.listdir(self.path)):
+            if name == COMPLETE_MARKER:
+                continue
+            try:
+                with gzip.open(os.path.join(self.path, name), "rt", encoding="utf-8") as f:
+                    for line in f:
+                        if not line.endswith("}\n"):
+                            continue
+                        url = json.loads(line[:line.index(', "body": ')] + "}")["url"]
+                        self._lines[url] = line
+            except EOFError:
+                # archive of an interrupted run, the lines read so far are kept
+                print(f"{name} is truncated")
+        self.stats = {"served": 0, "missing": 0}
+        print(f"Replaying {len(self._lines)} responses from {self.path}")
+
+    def lookup(self, url):
+        """archived body of a url
+
+        Returns:
+            dict: decoded json body, None if the url was not archived
+        """
+        line = self._lines.get(url)
+        if line is None:
+            self.stats["missing"] += 1
+            return None
+        self.stats["served"] += 1
+        return json.loads(line)["body"]
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+# Directory for local state kept between runs
+CACHE_DIR = os.environ.get("PUIG_CACHE_DIR", ".cache")
+# Seconds a cached response is served without asking the API, per endpoint family.
+# A TTL of 0 always sends a conditional request. Override with PUIG_CACHE_TTLS, e.g.
+# PUIG_CACHE_TTLS='{"products/{id}": 3600}'
+CACHE_TTLS = {
+    "bikes": 0,
+    "bikes/{id}": 6 * 3600,
+    "categories": 0,
+    "categories/{id}": 6 * 3600,
+    "products": 0,
+    "products/{id}": 6 * 3600,
+    "references": 0,
+    "references/{code}": 6 * 3600,
+    # stock and price live here, always revalidate
+    "references/{code}/{colour}": 0,
+}
+CACHE_TTLS.update(json.loads(os.environ.get("PUIG_CACHE_TTLS", "{}")))
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# ENDPOINT FAMILIES
+# -------------------------------------------------------------------------------------------------------------------------------
+
+_FAMILY_PATTERN = re.compile(r"^https?://[^/]+/[a-z]{2}/([^/?]+)(/[^/?]+)?(/[^/?]+)?")
+_FAMILY_PARAMS = {"bikes": ["{id}"], "categories": ["{id}"], "products": ["{id}"], "references": ["{code}", "{colour}"]}
+
+
+def endpoint_family(url):
+    """group an API url with the others of its kind
+
+    Args:
+        url (string): API url, e.g. https://api.puig.tv/en/references/3755/N
+
+    Returns:
+        string: endpoint family, e.g. references/{code}/{colour}
+    """
+    match = _FAMILY_PATTERN.match(url)
+    if match is None:
+        return url
+    resource = match.group(1)
+    params = _FAMILY_PARAMS.get(resource, ["{id}", "{id}"])
+    depth = len([group for group in match.groups()[1:] if group])
+    return "/".join([resource] + params[:depth])
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# RESPONSE CACHE
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+class ResponseCache:
+    """On-disk cache of API response bodies keyed by url.
+
+    Each entry keeps the compressed body, the ETag and Last-Modified validators and a
+    content hash. Entries younger than their family's TTL are served directly; older
+    ones are revalidated with a conditional request.
+
+    Args:
+        path (string): optional argument. SQLite file to store the cache in
+    """
+
+    def __init__(self, path=None):
+        path = path or os.path.join(CACHE_DIR, "responses.sqlite")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                url TEXT PRIMARY KEY,
+                body BLOB NOT NULL,
+                etag TEXT,
+                last_modified TEXT,
+                content_hash TEXT NOT NULL,
+                stored_at REAL NOT NULL
+            )"""
+        )
+        self._db.commit()
+        # hit: served without a request, revalidated: 304 answer,
+        # unchanged: full 200 answer with the same content, miss: new or changed content
+        self.stats = {"hit": 0, "revalidated": 0, "unchanged": 0, "miss": 0}
+
+    def lookup(self, url):
+        """find a cached response
+
+        Args:
+            url (string): API url
+
+        Returns:
+            tuple: (fresh, body, request headers for a conditional request), None if not cached
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT body, etag, last_modified, stored_at FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        body, etag, last_modified, stored_at = row
+        fresh = time.time() - stored_at < CACHE_TTLS.get(endpoint_family(url), 0)
+        conditional = {}
+        if etag:
+            conditional["If-None-Match"] = etag
+        if last_modified:
+            conditional["If-Modified-Since"] = last_modified
+        return fresh, zlib.decompress(body), conditional
+
+    def store(self, url, body, etag=None, last_modified=None):
+        """store a 200 response
+
+        Args:
+            url (string): API url
+            body (bytes): raw response body
+            etag (string): optional argument. ETag header of the response
+            last_modified (string): optional argument. Last-Modified header of the response
+
+        Returns:
+            boolean: True if the content differs from the cached copy
+        """
+        content_hash = hashlib.sha1(body).hexdigest()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT content_hash FROM responses WHERE url = ?", (url,)
+            ).fetchone()
+            changed = row is None or row[0] != content_hash
+            if changed:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                    (url, zlib.compress(body), etag, last_modified, content_hash, time.time()),
+                )
+            else:
+                self._db.execute(
+                    "UPDATE responses SET etag = ?, last_modified = ?, stored_at = ? WHERE url = ?",
+                    (etag, last_modified, time.time(), url),
+                )
+            self._db.commit()
+            self.stats["miss" if changed else "unchanged"] += 1
+        return changed
+
+    def touch(self, url):
+        """mark a cached response as revalidated after a 304 answer
+
+        Args:
+            url (string): API url
+        """
+        with self._lock:
+            self._db.execute("UPDATE responses SET stored_at = ? WHERE url = ?", (time.time(), url))
+            self._db.commit()
+            self.stats["revalidated"] += 1
+
+    def count_hit(self):
+        with self._lock:
+            self.stats["hit"] += 1
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,31 +1,64 @@
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from sqlalchemy import create_engine
+# google auth, googleapiclient and gspread are imported by the functions using them,
+# runs that never touch Google (e.g. --stages variant_stock) skip their import time
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import OperationalError
 import pandas as pd
-import requests
 import urllib
-import gspread
 import shutil
 import json
 import ssl
 import os
+import io
+import csv
+import time
+import threading
 import concurrent.futures
 from notification import send_email
+from api_cache import CACHE_DIR
+from api_records import RecordAccumulator
+from api_schema import SCHEMAS, sql_types
+import api_metrics
 
 pool = None
 sa = None
+sheets = None
 drive_service = None
+drive_credentials = None
+# Builds a Drive client per thread for read_gdrive_many(), replace with a fake for offline runs
+drive_service_factory = None
+# Rows sent per COPY batch in bulk mode, bounds the size of the in-memory CSV buffer
+COPY_CHUNKSIZE = int(os.environ.get('PUIG_COPY_CHUNKSIZE', '10000'))
+# Cells sent per batch_update call by sh_sync, keeps each request within API quota and payload limits
+SHEET_CHUNK_CELLS = int(os.environ.get('PUIG_SHEET_CHUNK_CELLS', '40000'))
+# Decoded rows a ChunkedWriter buffers before writing them, bounds the memory of the fetch stages
+SINK_CHUNK_ROWS = int(os.environ.get('PUIG_SINK_CHUNK_ROWS', '20000'))
+# Seconds the swap of a shadow table waits for locks before trying again, and how many times it tries
+SWAP_LOCK_TIMEOUT = 2
+SWAP_ATTEMPTS = 10
+# Directory of the Google Drive listing manifests
+MANIFEST_DIR = os.path.join(CACHE_DIR, 'drive')
+# Days after which read_gdrive lists a folder in full again
+DRIVE_FULL_SYNC_DAYS = 7
+# Folders listed at the same time by read_gdrive_many
+DRIVE_MAX_WORKERS = 4
+# Workbooks larger than this many bytes are parsed with openpyxl in read-only streaming mode
+STREAM_PARSE_BYTES = 20 * 1024 * 1024
 
 
 def connect_to_db():
-    """Connect to the database."""
+    """Connect to the database.
+
+    PUIG_DB_URL, when set, is used as the sqlalchemy url instead of the INSTANCE_HOST,
+    DB_USER, DB_PASS, DB_PUIG and DB_PORT variables (e.g. sqlite:///bench.db for offline runs).
+    """
     global pool
+    db_url = os.environ.get('PUIG_DB_URL')
     db_host = os.environ.get('INSTANCE_HOST')
     db_user = os.environ.get('DB_USER')
     db_pass = os.environ.get('DB_PASS')
     db_name = os.environ.get('DB_PUIG')
     db_port = os.environ.get('DB_PORT')
-    connect_string = f"postgresql+psycopg2://{db_user}:{urllib.parse.quote_plus(db_pass)}@{db_host}:{db_port}/{db_name}"
+    connect_string = db_url or f"postgresql+psycopg2://{db_user}:{urllib.parse.quote_plus(db_pass or '')}@{db_host}:{db_port}/{db_name}"
     try:
         pool = create_engine(connect_string)
         # pool.autocommit = True
@@ -37,14 +70,21 @@ def connect_to_db():
 
 def connect_to_serv_acc():
     """Connect to the google service account and Google drive API."""
+    import gspread
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
     global sa
+    global sheets
     global drive_service
+    global drive_credentials
+    global drive_service_factory
     service_acc = os.environ.get('PMGCPKEY')
     # Authenticate and build the Google Sheets API client using a service account
     sa = gspread.service_account(filename=service_acc)
     # *****IMPORTANT*****
     # uncomment the line below and comment the line above before cloud deployment
     # sa = gspread.service_account_from_dict(json.loads(os.environ.get('PMGCPKEY')))
+    sheets = SheetsSession(sa)
 
     # Authenticate and build the Google Drive API client using a service account
     credentials = service_account.Credentials.from_service_account_file(
@@ -53,6 +93,127 @@ def connect_to_serv_acc():
     # uncomment the line below and comment the line above before cloud deployment
     # credentials = service_account.Credentials.from_service_account_file(json.loads(os.environ.get('PMGCPKEY')))
     drive_service = build('drive', 'v3', credentials=credentials)
+    drive_credentials = credentials
+    drive_service_factory = _drive_service
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# GSHEETS SESSION
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def _cells(update):
+    """number of cells in a queued range update"""
+    return sum(len(row) for row in update['values'])
+
+
+class SheetsSession:
+    """Google sheets handles and queued writes shared by a whole run.
+
+    Each workbook is opened once and worksheet handles are cached until invalidated.
+    Writes are queued and sent by flush() with one values_batch_update per workbook and
+    value input option, split into chunks of SHEET_CHUNK_CELLS cells.
+
+    Args:
+        client (gspread.Client): authorised gspread client
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._workbooks = {}
+        self._worksheets = {}
+        # wbook -> list of (wsheet, raw, {'range': ..., 'values': ...})
+        self._queued = {}
+        self._lock = threading.RLock()
+
+    def workbook(self, wbook):
+        """cached handle of a workbook"""
+        with self._lock:
+            if wbook not in self._workbooks:
+                self._workbooks[wbook] = self.client.open(wbook)
+            return self._workbooks[wbook]
+
+    def worksheet(self, wbook, wsheet):
+        """cached handle of a worksheet"""
+        with self._lock:
+            if (wbook, wsheet) not in self._worksheets:
+                self._worksheets[(wbook, wsheet)] = self.workbook(wbook).worksheet(wsheet)
+            return self._worksheets[(wbook, wsheet)]
+
+    def invalidate(self, wbook=None, wsheet=None):
+        """forget cached handles, e.g. after a worksheet was renamed or recreated
+
+        Args:
+            wbook (string): optional argument. Workbook to forget, all of them if None
+            wsheet (string): optional argument. Only forget this worksheet of wbook
+        """
+        with self._lock:
+            if wbook is None:
+                self._workbooks.clear()
+                self._worksheets.clear()
+                return
+            if wsheet is None:
+                self._workbooks.pop(wbook, None)
+            for cached in [cached for cached in self._worksheets if cached[0] == wbook]:
+                if wsheet is None or cached[1] == wsheet:
+                    del self._worksheets[cached]
+
+    def read_values(self, wbook, wsheet):
+        """all values of a worksheet, sending queued writes to that workbook first"""
+        with self._lock:
+            if any(queued[0] == wsheet for queued in self._queued.get(wbook, [])):
+                self.flush(wbook)
+            return self.worksheet(wbook, wsheet).get_all_values()
+
+    def queue(self, wbook, wsheet, range_name, values, raw=True):
+        """queue a write to be sent by flush()
+
+        Args:
+            wbook (string): gsheet workbook to write to
+            wsheet (string): gsheet sheet to write to
+            range_name (string): A1 range within the sheet
+            values (list): rows of values
+            raw (boolean): optional argument. Set to False for formulas
+        """
+        title = wsheet.replace("'", "''")
+        with self._lock:
+            self._queued.setdefault(wbook, []).append(
+                (wsheet, raw, {'range': f"'{title}'!{range_name}", 'values': values}))
+
+    def flush(self, wbook=None):
+        """send the queued writes
+
+        Args:
+            wbook (string): optional argument. Only flush this workbook
+        """
+        with self._lock:
+            for name in [wbook] if wbook is not None else list(self._queued):
+                queued = self._queued.pop(name, [])
+                for raw in (True, False):
+                    batch = []
+                    cells = 0
+                    for wsheet, queued_raw, update in queued:
+                        if queued_raw != raw:
+                            continue
+                        if batch and cells + _cells(update) > SHEET_CHUNK_CELLS:
+                            self._send(name, raw, batch)
+                            batch, cells = [], 0
+                        batch.append(update)
+                        cells += _cells(update)
+                    if batch:
+                        self._send(name, raw, batch)
+
+    def _send(self, wbook, raw, data):
+        t0 = time.time()
+        self.workbook(wbook).values_batch_update(
+            body={'valueInputOption': 'RAW' if raw else 'USER_ENTERED', 'data': data})
+        api_metrics.record_write('sheets_flush', wbook, sum(len(update['values']) for update in data), time.time() - t0)
+        print(f"{wbook}: sent {len(data)} ranges in one values_batch_update")
+
+
+def flush_sheets():
+    """send every write queued in the run's sheets session"""
+    if sheets is not None:
+        sheets.flush()
 # -------------------------------------------------------------------------------------------------------------------------------
 
 # GSHEETS READ & WRITE
@@ -72,10 +233,8 @@ def sh_read(wbook, wsheet):
         dataframe: data read from gsheet
 
     """
-    # select workbook
-    sh = sa.open(wbook)
     # select worksheet
-    wks = sh.worksheet(wsheet)
+    wks = sheets.worksheet(wbook, wsheet)
     # get all records as pandas data frame
     df = pd.DataFrame(wks.get_all_records())
     return df
@@ -90,12 +249,126 @@ def sh_write(df, wbook, wsheet, x=True):
         wsheet (string): gsheet sheet to write to
         x (boolean): optional argument. Set to False if script writes formulas to sheets
     """
+    t0 = time.time()
     # establish connection
-    sh = sa.open(wbook)
-    wks = sh.worksheet(wsheet)
+    wks = sheets.worksheet(wbook, wsheet)
     wks.clear()
     # writing to sheet
     wks.update([df.columns.values.tolist()] + df.values.tolist(), raw=x)
+    api_metrics.record_write('sheets', f"{wbook}/{wsheet}", len(df), time.time() - t0)
+
+
+def _sheet_cell(value):
+    """value as sent to gsheets, NaN and None become empty cells"""
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    return value
+
+
+def _sheet_text(value):
+    """value as gsheets displays it, to compare with get_all_values()"""
+    value = _sheet_cell(value)
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _keyed(rows, column):
+    """pair each row with its key, numbering repeated keys so every pair is unique"""
+    seen = {}
+    keyed = []
+    for row in rows:
+        value = _sheet_text(row[column]) if column < len(row) else ''
+        seen[value] = seen.get(value, 0) + 1
+        keyed.append(((value, seen[value]), row))
+    return keyed
+
+
+def sheet_diff(current, df, key=None):
+    """compute the blocks of rows of a sheet that differ from a dataframe
+
+    With a key column, rows already in the sheet keep their position, rows whose key
+    disappeared are removed and new keys are appended at the end. Without one, or if
+    the header changed, rows are compared by position.
+
+    Args:
+        current (list): rows returned by get_all_values()
+        df (dataframe): data the sheet should hold
+        key (string): optional argument. Column identifying a row
+
+    Returns:
+        tuple: (list of (first row number, rows) blocks to write, number of columns)
+    """
+    header = [str(column) for column in df.columns]
+    rows = [[_sheet_cell(value) for value in row] for row in df.values.tolist()]
+    if key is not None and current and current[0] == header:
+        column = header.index(key)
+        new = dict(_keyed(rows, column))
+        old = [row_key for row_key, row in _keyed(current[1:], column)]
+        kept = set(old)
+        rows = [new[row_key] for row_key in old if row_key in new] + [
+            row for row_key, row in new.items() if row_key not in kept
+        ]
+    grid = [header] + rows
+    width = max([len(header)] + [len(row) for row in current])
+    blocks = []
+    for i in range(max(len(grid), len(current))):
+        wanted = grid[i] + [''] * (width - len(grid[i])) if i < len(grid) else [''] * width
+        present = current[i] + [''] * (width - len(current[i])) if i < len(current) else [''] * width
+        if [_sheet_text(value) for value in wanted] == present:
+            continue
+        if blocks and blocks[-1][0] + len(blocks[-1][1]) == i + 1:
+            blocks[-1][1].append(wanted)
+        else:
+            blocks.append((i + 1, [wanted]))
+    return blocks, width
+
+
+def _sheet_ranges(blocks, width, max_cells):
+    """split changed blocks into A1 ranges of at most max_cells cells"""
+    from gspread.utils import rowcol_to_a1
+    rows_per_range = max(1, max_cells // max(width, 1))
+    for first_row, rows in blocks:
+        for start in range(0, len(rows), rows_per_range):
+            values = rows[start:start + rows_per_range]
+            row = first_row + start
+            yield f"{rowcol_to_a1(row, 1)}:{rowcol_to_a1(row + len(values) - 1, width)}", values
+
+
+def sh_sync(df, wbook, wsheet, key=None, x=True):
+    """writing only the changed rows of a dataframe to gsheet
+
+    The sheet is read once and diffed against the dataframe. The changed row ranges
+    are queued on the sheets session and sent with the other writes of the run by
+    flush_sheets(). The sheet is never cleared, so readers never see it empty.
+
+    Args:
+        df (dataframe): dataframe data to write
+        wbook (string): gsheet workbook to write to
+        wsheet (string): gsheet sheet to write to
+        key (string): optional argument. Column identifying a row, rows are compared by position without it
+        x (boolean): optional argument. Set to False if script writes formulas to sheets
+    """
+    t0 = time.time()
+    blocks, width = sheet_diff(sheets.read_values(wbook, wsheet), df, key)
+    if not blocks:
+        api_metrics.record_write('sheets', f"{wbook}/{wsheet}", 0, time.time() - t0)
+        print(f"{wsheet}: sheet already up to date")
+        return
+    # grow the grid now if the data no longer fits, the values follow with the flush
+    wks = sheets.worksheet(wbook, wsheet)
+    last_row = max(first_row + len(rows) - 1 for first_row, rows in blocks)
+    if last_row > wks.row_count:
+        wks.add_rows(last_row - wks.row_count)
+    if width > wks.col_count:
+        wks.add_cols(width - wks.col_count)
+    for range_name, values in _sheet_ranges(blocks, width, SHEET_CHUNK_CELLS):
+        sheets.queue(wbook, wsheet, range_name, values, raw=x)
+    changed = sum(len(rows) for first_row, rows in blocks)
+    api_metrics.record_write('sheets', f"{wbook}/{wsheet}", changed, time.time() - t0)
+    print(f"{wsheet}: queued {changed} changed rows")
 
 
 def set_formula(wbook, wsheet, cell, formula):
@@ -107,30 +380,505 @@ def set_formula(wbook, wsheet, cell, formula):
         cell (string): gsheet cell to write to
         formula (string): formula to write
     """
-    # establish connection
-    sh = sa.open(wbook)
-    wks = sh.worksheet(wsheet)
-    # writing to sheet
-    wks.update(cell, formula, raw=False)
+    # queued with the other writes of the run, sent by flush_sheets()
+    sheets.queue(wbook, wsheet, cell, [[formula]], raw=False)
 # -------------------------------------------------------------------------------------------------------------------------------
 
 # DATABASE READ AND WRITE
 # -------------------------------------------------------------------------------------------------------------------------------
 
 
-def db_write(df, table):
+def db_write(df, table, mode='replace', key=None, delete_missing=False, bulk=False, dtype=None):
     """writing to database table
 
     Args:
         df (dataframe): dataframe data to write
         table (string): table name to write to
+        mode (string): optional argument. 'replace' rewrites the whole table, 'upsert' only writes rows whose content changed,
+            'swap' loads a shadow copy of the table and swaps it in, so readers never see it missing or half written
+        key (string or list): optional argument. Natural key column(s) of the table, required by 'upsert', primary key for 'swap'
+        delete_missing (boolean or string): optional argument. Set to True to delete rows whose key is no longer in df,
+            or to a column name to only delete them among the values of that column present in df ('upsert' only)
+        bulk (boolean): optional argument. Set to True to stream rows with COPY FROM STDIN instead of INSERTs
+        dtype (dict): optional argument. SQL types by column, defaults to the declared schema of the table (see api_schema)
     """
-    # writing data to db
-    with pool.connect() as connection:
+    t0 = time.time()
+    if dtype is None:
+        dtype = sql_types(table, df)
+    if pool.dialect.name != 'postgresql':
+        _portable_write(df, table)
+    elif mode == 'upsert':
+        db_upsert(df, table, key, delete_missing, bulk, dtype)
+    elif mode == 'swap':
+        db_swap(df, table, key, bulk, dtype)
+    else:
+        # writing data to db
+        with pool.connect() as connection:
+            try:
+                df.to_sql(table, con=connection, if_exists='replace', index=False, dtype=dtype, **_to_sql_options(bulk))
+            finally:
+                connection.close()
+    api_metrics.record_write('db', table, len(df), time.time() - t0)
+    if bulk:
+        elapsed = time.time() - t0
+        print(f"{table}: loaded {len(df)} rows in {elapsed:.1f}s ({len(df) / max(elapsed, 1e-6):.0f} rows/sec)")
+
+
+def _portable_write(df, table, if_exists='replace'):
+    """replace a table on a database other than Postgres (e.g. SQLite for benchmarks)
+
+    COPY, ON CONFLICT on a row_hash and jsonb are Postgres only, so the table is
+    rewritten with plain INSERTs and nested values are stored as json text.
+
+    Args:
+        if_exists (string): optional argument. 'append' adds the rows to the table instead
+    """
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].map(_copy_value)
+    df.to_sql(table, con=pool, if_exists=if_exists, index=False, chunksize=COPY_CHUNKSIZE)
+
+
+def _copy_value(value):
+    """CSV cell for COPY, nested structures are sent as json"""
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
+def _copy_insert(table, conn, keys, data_iter):
+    """to_sql insertion method sending each chunk through psycopg2 COPY FROM STDIN
+
+    Args:
+        table (pandas.io.sql.SQLTable): table being written
+        conn (sqlalchemy.engine.Connection): connection used by to_sql
+        keys (list): column names
+        data_iter (iterable): rows of the chunk
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in data_iter:
+        writer.writerow([_copy_value(value) for value in row])
+    buffer.seek(0)
+    name = f"{_quote(table.schema)}.{_quote(table.name)}" if table.schema else _quote(table.name)
+    columns = ', '.join(_quote(k) for k in keys)
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+def _to_sql_options(bulk):
+    """extra to_sql arguments for bulk loading"""
+    if not bulk:
+        return {}
+    return {'method': _copy_insert, 'chunksize': COPY_CHUNKSIZE}
+
+
+def _quote(name):
+    """quote an sql identifier"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _column_types(connection, table):
+    """column names and sql types of an existing table, None if the table does not exist"""
+    if connection.execute(text("SELECT to_regclass(:t)"), {'t': _quote(table)}).scalar() is None:
+        return None
+    rows = connection.execute(text(
+        "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+        "WHERE attrelid = CAST(:t AS regclass) AND attnum > 0 AND NOT attisdropped ORDER BY attnum"),
+        {'t': _quote(table)})
+    return dict(rows.fetchall())
+
+
+def db_upsert(df, table, key, delete_missing=False, bulk=False, dtype=None):
+    """write only the rows of a table that changed
+
+    The dataframe is loaded into a staging table and merged into the target with
+    INSERT ... ON CONFLICT DO UPDATE. A row_hash column on the target holds the md5 of
+    each row, so rows whose content did not change are left untouched. Existing
+    column types (e.g. multimedia altered to JSONB) and indexes are kept.
+
+    Args:
+        df (dataframe): dataframe data to write
+        table (string): table name to write to
+        key (string or list): natural key column(s) of the table
+        delete_missing (boolean or string): optional argument. Set to True to delete rows whose key is no longer
+            in df. Set to a column (or list of columns) to limit the deletion to rows whose value in that column
+            appears in df, e.g. the links of the products that were fetched
+        bulk (boolean): optional argument. Set to True to load the staging table with COPY
+        dtype (dict): optional argument. SQL types by column, used when the table is created and to convert
+            columns an earlier run wrote as text
+    """
+    keys = [key] if isinstance(key, str) else list(key)
+    # rows without a key can not be matched
+    df = df.dropna(subset=keys)
+    staging = f"{table}__staging"
+    with pool.begin() as connection:
+        df.to_sql(staging, con=connection, if_exists='replace', index=False, dtype=dtype, **_to_sql_options(bulk))
+        changed, deleted = _merge_staging(connection, table, staging, keys, delete_missing, dtype)
+        connection.execute(text(f"DROP TABLE {_quote(staging)}"))
+    print(f"{table}: {changed} rows inserted/updated, {deleted} rows deleted, {len(df) - changed} unchanged")
+
+
+def _merge_staging(connection, table, staging, keys, delete_missing=False, dtype=None):
+    """merge a loaded staging table into its target, see db_upsert
+
+    Returns:
+        tuple: rows inserted or updated, rows deleted
+    """
+    staging_types = _column_types(connection, staging)
+    columns = list(staging_types)
+    target = _quote(table)
+    key_list = ', '.join(_quote(k) for k in keys)
+    row_hash = "md5(ROW(" + ', '.join(f"s.{_quote(c)}" for c in columns) + ")::text)"
+    types = _column_types(connection, table)
+    if types is None:
+        # first run, create the target from the staging layout
+        connection.execute(text(
+            f"CREATE TABLE {target} AS SELECT s.*, {row_hash} AS row_hash FROM {_quote(staging)} s WITH NO DATA"))
+        connection.execute(text(f"ALTER TABLE {target} ADD PRIMARY KEY ({key_list})"))
+    elif 'row_hash' not in types:
+        # table previously written with if_exists='replace', make it upsertable once
+        connection.execute(text(f"ALTER TABLE {target} ADD COLUMN row_hash text"))
+        connection.execute(text(
+            f"DELETE FROM {target} a USING {target} b WHERE a.ctid < b.ctid AND "
+            + ' AND '.join(f"a.{_quote(k)} = b.{_quote(k)}" for k in keys)))
+        connection.execute(text(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {_quote(table + '_key_uidx')} ON {target} ({key_list})"))
+    types = _column_types(connection, table)
+    for column in columns:
+        if column not in types:
+            connection.execute(text(f"ALTER TABLE {target} ADD COLUMN {_quote(column)} {staging_types[column]}"))
+            types[column] = staging_types[column]
+        elif dtype and column in dtype and types[column] == 'text' and staging_types[column] != 'text':
+            # column written as text before it had a declared type, convert it once
+            try:
+                with connection.begin_nested():
+                    connection.execute(text(
+                        f"ALTER TABLE {target} ALTER COLUMN {_quote(column)} TYPE {staging_types[column]} "
+                        f"USING CAST(NULLIF(NULLIF({_quote(column)}, 'null'), 'None') AS {staging_types[column]})"))
+                types[column] = staging_types[column]
+            except Exception as e:
+                print(f"{table}.{column} kept as text, it could not be converted to {staging_types[column]}: {e}")
+    # cast staging values to the target column types
+    select_list = ', '.join(f"CAST(s.{_quote(c)} AS {types[c]})" for c in columns)
+    insert_list = ', '.join(_quote(c) for c in columns)
+    update_list = ', '.join(f"{_quote(c)} = EXCLUDED.{_quote(c)}" for c in columns if c not in keys)
+    if update_list:
+        conflict = (f"DO UPDATE SET {update_list}, row_hash = EXCLUDED.row_hash "
+                    f"WHERE {target}.row_hash IS DISTINCT FROM EXCLUDED.row_hash")
+    else:
+        # every column is part of the key (e.g. link tables), an existing row can not change
+        conflict = "DO NOTHING"
+    result = connection.execute(text(
+        f"INSERT INTO {target} ({insert_list}, row_hash) "
+        f"SELECT DISTINCT ON ({', '.join('s.' + _quote(k) for k in keys)}) {select_list}, {row_hash} "
+        f"FROM {_quote(staging)} s ORDER BY {', '.join('s.' + _quote(k) for k in keys)} "
+        f"ON CONFLICT ({key_list}) {conflict}"))
+    changed = result.rowcount
+    deleted = 0
+    if delete_missing:
+        condition = (
+            f"NOT EXISTS (SELECT 1 FROM {_quote(staging)} s WHERE "
+            + ' AND '.join(f"CAST(s.{_quote(k)} AS {types[k]}) = t.{_quote(k)}" for k in keys) + ")")
+        if delete_missing is not True:
+            scope = [delete_missing] if isinstance(delete_missing, str) else list(delete_missing)
+            condition += (
+                f" AND EXISTS (SELECT 1 FROM {_quote(staging)} s WHERE "
+                + ' AND '.join(f"CAST(s.{_quote(c)} AS {types[c]}) = t.{_quote(c)}" for c in scope) + ")")
+        result = connection.execute(text(f"DELETE FROM {target} t WHERE {condition}"))
+        deleted = result.rowcount
+    return changed, deleted
+
+
+def _indexes(connection, table):
+    """name, primary, unique flags and definition of the indexes of a table"""
+    return connection.execute(text(
+        "SELECT c.relname, i.indisprimary, i.indisunique, pg_get_indexdef(i.indexrelid) "
+        "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE i.indrelid = CAST(:t AS regclass)"),
+        {'t': _quote(table)}).fetchall()
+
+
+def _dependent_views(connection, table):
+    """names of the views and materialized views reading a table, empty if it does not exist"""
+    if connection.execute(text("SELECT to_regclass(:t)"), {'t': _quote(table)}).scalar() is None:
+        return []
+    rows = connection.execute(text(
+        "SELECT DISTINCT CAST(r.ev_class AS regclass) FROM pg_depend d JOIN pg_rewrite r ON r.oid = d.objid "
+        "WHERE d.classid = CAST('pg_rewrite' AS regclass) AND d.refobjid = CAST(:t AS regclass) "
+        "AND r.ev_class <> d.refobjid"), {'t': _quote(table)})
+    return [str(row[0]) for row in rows]
+
+
+def db_swap(df, table, key=None, bulk=False, dtype=None):
+    """replace a table without readers ever seeing it missing or half written
+
+    The dataframe is loaded into <table>__new and the indexes of the current table
+    (primary key included) are rebuilt on it, all while readers keep using the current
+    table. The two are then swapped by renaming them in one short transaction, and the
+    old table is dropped afterwards. The swap gives up after SWAP_LOCK_TIMEOUT seconds
+    instead of queueing behind long-running queries, and is retried. Grants on the
+    table are not carried over.
+
+    Views follow a renamed table, so they would keep reading the old rows and keep it
+    from being dropped. A table that views depend on is therefore never swapped.
+
+    Args:
+        df (dataframe): dataframe data to write
+        table (string): table name to replace
+        key (string or list): optional argument. Primary key column(s), if the table has none yet
+        bulk (boolean): optional argument. Set to True to load the shadow table with COPY
+        dtype (dict): optional argument. SQL types by column
+
+    Raises:
+        RuntimeError: if views depend on the table, or on the old copy left by an earlier swap
+    """
+    new, old = f"{table}__new", f"{table}__old"
+    keys = [] if key is None else [key] if isinstance(key, str) else list(key)
+    with pool.begin() as connection:
+        views = _dependent_views(connection, table)
+        if views:
+            raise RuntimeError(
+                f"{table} can not be swapped, views depend on it: {', '.join(views)}. "
+                f"Drop them or write {table} with mode='upsert'")
+        views = _dependent_views(connection, old)
+        if views:
+            raise RuntimeError(
+                f"{old} left by an earlier swap is still read by views: {', '.join(views)}. "
+                f"Recreate them on {table} and drop {old}")
+        connection.execute(text(f"DROP TABLE IF EXISTS {_quote(old)}"))
+        df.to_sql(new, con=connection, if_exists='replace', index=False, dtype=dtype, **_to_sql_options(bulk))
+        types = _column_types(connection, table)
+        indexes = _indexes(connection, table) if types is not None else []
+        existing = [name for name, primary, unique, definition in indexes]
+        if types is not None and 'row_hash' in types:
+            # keep the table upsertable, with the same hash db_upsert computes
+            columns = ', '.join(f"n.{_quote(c)}" for c in df.columns)
+            connection.execute(text(f"ALTER TABLE {_quote(new)} ADD COLUMN row_hash text"))
+            connection.execute(text(f"UPDATE {_quote(new)} n SET row_hash = md5(ROW({columns})::text)"))
+        if keys and not any(primary for name, primary, unique, definition in indexes):
+            indexes.append((f"{table}_pkey", True, True,
+                            f"CREATE UNIQUE INDEX ON {_quote(table)} USING btree ({', '.join(_quote(k) for k in keys)})"))
+        for name, primary, unique, definition in indexes:
+            connection.execute(text(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX {_quote(name + '__new')} ON {_quote(new)} "
+                f"USING {definition.split(' USING ', 1)[1]}"))
+            if primary:
+                connection.execute(text(
+                    f"ALTER TABLE {_quote(new)} ADD CONSTRAINT {_quote(name + '__new')} "
+                    f"PRIMARY KEY USING INDEX {_quote(name + '__new')}"))
+    # swap the names, the only step taking locks readers wait on
+    for attempt in range(SWAP_ATTEMPTS):
+        t0 = time.time()
         try:
-            df.to_sql(table, con=connection, if_exists='replace', index=False)
-        finally:
-            connection.close()
+            with pool.begin() as connection:
+                connection.execute(text(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}s'"))
+                if types is not None:
+                    connection.execute(text(f"ALTER TABLE {_quote(table)} RENAME TO {_quote(old)}"))
+                    for name in existing:
+                        connection.execute(text(f"ALTER INDEX {_quote(name)} RENAME TO {_quote(name + '__old')}"))
+                connection.execute(text(f"ALTER TABLE {_quote(new)} RENAME TO {_quote(table)}"))
+                for name, primary, unique, definition in indexes:
+                    connection.execute(text(f"ALTER INDEX {_quote(name + '__new')} RENAME TO {_quote(name)}"))
+            break
+        except OperationalError as e:
+            if attempt == SWAP_ATTEMPTS - 1:
+                raise e
+            print(f"{table}: swap waited {SWAP_LOCK_TIMEOUT}s for locks, retrying ({attempt + 1}/{SWAP_ATTEMPTS})")
+            time.sleep(SWAP_LOCK_TIMEOUT)
+    print(f"{table}: swapped in {len(df)} rows, tables locked for {(time.time() - t0) * 1000:.0f}ms")
+    if types is not None:
+        try:
+            with pool.begin() as connection:
+                connection.execute(text(f"DROP TABLE {_quote(old)}"))
+        except Exception as e:
+            # e.g. a view created during the swap, the next swap raises until it is recreated on table
+            print(f"{table}: could not drop {old}: {e}")
+
+
+def db_update_columns(df, table, key, bulk=False, dtype=None):
+    """patch some columns of rows that already exist in a table
+
+    The dataframe holds the key column(s) and the columns to patch. It is loaded into a
+    staging table and applied with a single UPDATE ... FROM, touching only rows whose
+    values differ. Rows whose key is not in the table are ignored. The row_hash of
+    patched rows is cleared so the next upsert rewrites them in full.
+
+    Args:
+        df (dataframe): key column(s) and columns to patch
+        table (string): table name to patch
+        key (string or list): natural key column(s) of the table
+        bulk (boolean): optional argument. Set to True to load the staging table with COPY
+        dtype (dict): optional argument. SQL types of the staging columns, defaults to the declared schema of the table
+    """
+    t0 = time.time()
+    if dtype is None:
+        dtype = sql_types(table, df)
+    keys = [key] if isinstance(key, str) else list(key)
+    columns = [str(column) for column in df.columns if column not in keys]
+    staging = f"{table}__patch"
+    target = _quote(table)
+    if pool.dialect.name != 'postgresql':
+        # no typed staging table, send one UPDATE per row
+        set_list = ', '.join(f"{_quote(c)} = :p{i}" for i, c in enumerate(columns))
+        where = ' AND '.join(f"{_quote(k)} = :k{i}" for i, k in enumerate(keys))
+        values = df.astype(object).where(df.notna(), None)
+        params = [
+            {**{f"p{i}": row[c] for i, c in enumerate(columns)}, **{f"k{i}": row[k] for i, k in enumerate(keys)}}
+            for row in values.to_dict('records')
+        ]
+        with pool.begin() as connection:
+            changed = connection.execute(text(f"UPDATE {target} SET {set_list} WHERE {where}"), params).rowcount
+        api_metrics.record_write('db', table, changed, time.time() - t0)
+        print(f"{table}: patched {', '.join(columns)} on {changed} of {len(df)} rows in {time.time() - t0:.1f}s")
+        return
+    with pool.begin() as connection:
+        df.to_sql(staging, con=connection, if_exists='replace', index=False, dtype=dtype, **_to_sql_options(bulk))
+        types = _column_types(connection, table)
+        new_values = ', '.join(f"CAST(s.{_quote(c)} AS {types[c]})" for c in columns)
+        set_list = ', '.join(f"{_quote(c)} = CAST(s.{_quote(c)} AS {types[c]})" for c in columns)
+        if 'row_hash' in types:
+            set_list += ", row_hash = NULL"
+        result = connection.execute(text(
+            f"UPDATE {target} t SET {set_list} FROM {_quote(staging)} s WHERE "
+            + ' AND '.join(f"t.{_quote(k)} = CAST(s.{_quote(k)} AS {types[k]})" for k in keys)
+            + f" AND ROW({', '.join('t.' + _quote(c) for c in columns)}) IS DISTINCT FROM ROW({new_values})"))
+        changed = result.rowcount
+        connection.execute(text(f"DROP TABLE {_quote(staging)}"))
+    api_metrics.record_write('db', table, changed, time.time() - t0)
+    print(f"{table}: patched {', '.join(columns)} on {changed} of {len(df)} rows in {time.time() - t0:.1f}s")
+
+
+class ChunkedWriter:
+    """Write a table from decoded rows every SINK_CHUNK_ROWS rows instead of building it whole.
+
+    Each chunk is built into a typed frame, passed through transform and appended with
+    COPY to <table>__stream. finish() then merges the streamed rows into the table in one
+    transaction, like db_write(mode='upsert'), or renames them over it with mode='replace'.
+    Only one chunk of rows is in memory at a time, however large the catalogue. On databases
+    other than Postgres the streamed rows always replace the table, as db_write does.
+
+    Args:
+        table (string): table name to write to
+        columns (list): column names of the appended rows, in tuple order
+        key (string or list): optional argument. Natural key column(s), required by 'upsert'
+        mode (string): optional argument. 'upsert' (default) or 'replace'
+        transform (function): optional argument. Called with the frame of each chunk, returns the frame to write
+        delete_missing (boolean or string): optional argument. Passed to the merge, see db_upsert ('upsert' only)
+        schema (string): optional argument. Table name in SCHEMAS whose declared types the chunks get,
+            defaults to table
+        index (string or list): optional argument. Column(s) indexed once the table is written
+        chunk_rows (int): optional argument. Defaults to SINK_CHUNK_ROWS
+    """
+
+    def __init__(self, table, columns, key=None, mode='upsert', transform=None, delete_missing=False,
+                 schema=None, index=None, chunk_rows=None):
+        self.table = table
+        self.columns = list(columns)
+        self.keys = [key] if isinstance(key, str) else list(key or [])
+        self.mode = mode
+        self.transform = transform
+        self.delete_missing = delete_missing
+        self.schema = schema or table
+        self.index = index
+        self.chunk_rows = chunk_rows or SINK_CHUNK_ROWS
+        self.stream = f"{table}__stream"
+        self.records = RecordAccumulator(self.columns)
+        self.rows = 0
+        self.chunks = 0
+        self.seconds = 0.0
+
+    def extend(self, rows):
+        """append decoded rows, writing a chunk once enough are buffered
+
+        Args:
+            rows (list): records in columns order
+        """
+        self.records.extend(rows)
+        if len(self.records) >= self.chunk_rows:
+            self.flush()
+
+    def flush(self, empty=False):
+        """write the buffered rows to the stream table
+
+        Args:
+            empty (boolean): optional argument. Set to True to create the stream table even without rows
+        """
+        if not len(self.records) and not empty:
+            return
+        t0 = time.time()
+        df = self.records.to_frame(SCHEMAS.get(self.schema))
+        self.records = RecordAccumulator(self.columns)
+        if self.transform is not None:
+            df = self.transform(df)
+        if self.keys:
+            # rows without a key can not be matched
+            df = df.dropna(subset=self.keys)
+        if_exists = 'append' if self.chunks else 'replace'
+        if pool.dialect.name != 'postgresql':
+            _portable_write(df, self.stream, if_exists)
+        else:
+            df.to_sql(self.stream, con=pool, if_exists=if_exists, index=False,
+                      dtype=sql_types(self.schema, df), **_to_sql_options(True))
+        self.rows += len(df)
+        self.chunks += 1
+        self.seconds += time.time() - t0
+
+    def finish(self):
+        """write the last chunk and move the streamed rows into the table"""
+        # a replaced table exists afterwards even without rows, e.g. for merge_shards
+        self.flush(empty=self.mode == 'replace' and not self.chunks)
+        if not self.chunks:
+            print(f"{self.table}: no rows to write")
+            return
+        t0 = time.time()
+        if self.mode == 'upsert' and pool.dialect.name == 'postgresql':
+            with pool.begin() as connection:
+                changed, deleted = _merge_staging(
+                    connection, self.table, self.stream, self.keys, self.delete_missing, sql_types(self.schema))
+                connection.execute(text(f"DROP TABLE {_quote(self.stream)}"))
+            print(f"{self.table}: {changed} rows inserted/updated, {deleted} rows deleted, "
+                  f"{self.rows - changed} unchanged")
+        else:
+            with pool.begin() as connection:
+                connection.execute(text(f"DROP TABLE IF EXISTS {_quote(self.table)}"))
+                connection.execute(text(f"ALTER TABLE {_quote(self.stream)} RENAME TO {_quote(self.table)}"))
+        if self.index is not None:
+            db_create_index(self.table, self.index)
+        self.seconds += time.time() - t0
+        api_metrics.record_write('db', self.table, self.rows, self.seconds)
+        print(f"{self.table}: streamed {self.rows} rows in {self.chunks} chunks in {self.seconds:.1f}s")
+
+
+def db_merge(sources, table, key, delete_missing=False, dtype=None):
+    """upsert the rows of tables laid out like table into it, without reading them into memory
+
+    The sources are copied into one staging table with UNION ALL and merged like
+    db_write(mode='upsert'). On databases other than Postgres they replace the table.
+
+    Args:
+        sources (list): names of the tables to merge, e.g. the shard tables of table
+        table (string): table name to write to
+        key (string or list): natural key column(s) of the table
+        delete_missing (boolean or string): optional argument. See db_upsert
+        dtype (dict): optional argument. SQL types by column, defaults to the declared schema of the table
+    """
+    t0 = time.time()
+    keys = [key] if isinstance(key, str) else list(key)
+    if dtype is None:
+        dtype = sql_types(table)
+    union = ' UNION ALL '.join(f"SELECT * FROM {_quote(source)}" for source in sources)
+    target = table if pool.dialect.name != 'postgresql' else f"{table}__staging"
+    with pool.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {_quote(target)}"))
+        connection.execute(text(f"CREATE TABLE {_quote(target)} AS {union}"))
+        rows = connection.execute(text(f"SELECT count(*) FROM {_quote(target)}")).scalar()
+        if target != table:
+            changed, deleted = _merge_staging(connection, table, target, keys, delete_missing, dtype)
+            connection.execute(text(f"DROP TABLE {_quote(target)}"))
+            print(f"{table}: {changed} rows inserted/updated, {deleted} rows deleted, {rows - changed} unchanged")
+    api_metrics.record_write('db', table, rows, time.time() - t0)
+    print(f"{table}: merged {rows} rows of {len(sources)} tables in {time.time() - t0:.1f}s")
 
 
 def db_read(sql_query):
@@ -149,6 +897,42 @@ def db_read(sql_query):
     return df
 
 
+def db_has_table(table):
+    """check if a table exists
+
+    Args:
+        table (string): table name
+
+    Returns:
+        boolean: True if the table exists
+    """
+    return inspect(pool).has_table(table)
+
+
+def db_create_index(table, columns):
+    """create an index if it does not exist yet
+
+    Args:
+        table (string): table name
+        columns (string or list): indexed column(s)
+    """
+    columns = [columns] if isinstance(columns, str) else list(columns)
+    name = f"{table}_{'_'.join(columns)}_idx"
+    with pool.begin() as connection:
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {_quote(name)} ON {_quote(table)} ({', '.join(_quote(c) for c in columns)})"))
+
+
+def db_drop(table):
+    """drop a table if it exists
+
+    Args:
+        table (string): table name
+    """
+    with pool.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {_quote(table)}"))
+
+
 def db_query(sql_query):
     """execute query on database
 
@@ -177,9 +961,59 @@ def download_file(url, filename):
             shutil.copyfileobj(response, f)
 
 
+def _remote_stat(url):
+    """Last-Modified and Content-Length of a remote file, None if the server does not tell"""
+    # Disable certificate verification
+    context = ssl._create_unverified_context()
+    request = urllib.request.Request(url, method='HEAD')
+    try:
+        with urllib.request.urlopen(request, context=context) as response:
+            stat = {'last_modified': response.headers.get('Last-Modified'),
+                    'content_length': response.headers.get('Content-Length')}
+    except Exception as e:
+        print(f"HEAD {url} failed: {e}")
+        return None
+    # without validators a cached copy can not be trusted
+    if stat['last_modified'] is None and stat['content_length'] is None:
+        return None
+    return stat
+
+
+def _read_excel_streaming(filename):
+    """parse the first sheet of a large workbook row by row with openpyxl in read-only mode"""
+    from openpyxl import load_workbook
+    workbook = load_workbook(filename, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, ())
+        records = RecordAccumulator([str(column) for column in header])
+        for row in rows:
+            if not any(value is not None for value in row):
+                continue
+            records.append(tuple(row[:len(header)]) + (None,) * (len(header) - len(row)))
+    finally:
+        workbook.close()
+    return records.to_frame()
+
+
+def _parquet_ready(df):
+    """make mixed-type object columns strings so the frame can be stored as parquet"""
+    df.columns = [str(column) for column in df.columns]
+    for column in df.columns[df.dtypes == object]:
+        values = df[column].dropna()
+        if not values.map(lambda value: isinstance(value, str)).all():
+            df[column] = df[column].map(lambda value: value if value is None or value != value else str(value))
+    return df
+
+
 def ftp_read(url, filename):
     """download files
 
+    The parsed workbook is cached as parquet next to the download, together with the
+    Last-Modified and Content-Length the server reported. While those are unchanged,
+    the download and the Excel parse are skipped and the parquet file is memory-mapped.
+    Without pyarrow only the download is skipped.
+
     Args:
         url (_type_): (string): url of the file to be downloaded
         filename (string): file name to be downloaded
@@ -187,9 +1021,39 @@ def ftp_read(url, filename):
     Returns:
         dataframe: data from downloaded file
     """
-    # read files from ftp
-    download_file(url, filename)
-    df = pd.read_excel(filename)
+    meta_path = filename + '.meta.json'
+    parquet_path = os.path.splitext(filename)[0] + '.parquet'
+    remote = _remote_stat(url)
+    cached = None
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as f:
+            cached = json.load(f)
+    unchanged = remote is not None and remote == cached
+    df = None
+    if unchanged and os.path.exists(parquet_path):
+        try:
+            df = pd.read_parquet(parquet_path, memory_map=True)
+        except ImportError:
+            # pandas needs pyarrow for parquet, without it every run parses the workbook
+            print(f"{parquet_path}: pyarrow is not installed, parsing the workbook")
+    if df is None:
+        # read files from ftp
+        if not (unchanged and os.path.exists(filename)):
+            download_file(url, filename)
+        if os.path.getsize(filename) > STREAM_PARSE_BYTES:
+            df = _read_excel_streaming(filename)
+        else:
+            df = pd.read_excel(filename)
+        df = _parquet_ready(df)
+        try:
+            df.to_parquet(parquet_path, index=False)
+        except ImportError:
+            print(f"{parquet_path}: pyarrow is not installed, the parsed workbook is not cached")
+        if remote is not None:
+            with open(meta_path, 'w', encoding='utf-8') as f:
+                json.dump(remote, f)
+        elif os.path.exists(meta_path):
+            os.remove(meta_path)
     df = df.fillna('')
     return df
 # -------------------------------------------------------------------------------------------------------------------------------
@@ -198,35 +1062,110 @@ def ftp_read(url, filename):
 # -------------------------------------------------------------------------------------------------------------------------------
 
 
-def read_gdrive(folder_id, file_type):
+def _drive_service():
+    """Drive API client for the calling thread, googleapiclient clients are not thread safe"""
+    from googleapiclient.discovery import build
+    return build('drive', 'v3', credentials=drive_credentials, cache_discovery=False)
+
+
+def _file_sku(name, file_type):
+    """SKU encoded in a Drive file name"""
+    if file_type == 'image/jpeg':
+        return name.split('-')[0]
+    if file_type == 'application/pdf':
+        return name[:-4]
+    return ''
+
+
+def _manifest_path(folder_id, file_type):
+    return os.path.join(MANIFEST_DIR, f"{folder_id}_{file_type.replace('/', '_')}.json")
+
+
+def read_gdrive(folder_id, file_type, full=False, service=None):
+    """list the files of a Google Drive folder
+
+    A local manifest (id, name, modifiedTime, SKU) is kept per folder and file type, so
+    only files modified since the last sync are listed. Trashed files are dropped from
+    the manifest; a full listing runs every DRIVE_FULL_SYNC_DAYS days to also catch
+    files deleted outright or moved out of the folder.
+
+    Args:
+        folder_id (string): id of the Drive folder
+        file_type (string): mime type of the files to list, e.g. image/jpeg
+        full (boolean): optional argument. Set to True to list every file again
+        service (googleapiclient resource): optional argument. Drive client, drive_service if None
+
+    Returns:
+        dataframe: SKU, Name, ID and URL of each file
+    """
+    service = service or drive_service
+    path = _manifest_path(folder_id, file_type)
+    manifest = None
+    if not full and os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+        if time.time() - manifest['full_sync'] > DRIVE_FULL_SYNC_DAYS * 86400:
+            manifest = None
+    # start a little early so files modified while listing are picked up next time
+    started = time.time() - 60
+    if manifest is None:
+        manifest = {'full_sync': started, 'synced_at': started, 'files': {}}
+        query = f"trashed = false and parents in '{folder_id}' and mimeType='{file_type}'"
+    else:
+        since = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(manifest['synced_at']))
+        # trashed files are included so they can be dropped from the manifest
+        query = f"parents in '{folder_id}' and mimeType='{file_type}' and modifiedTime > '{since}'"
 
     # Initialize variables for pagination
     page_token = None
-    items = []
-
-    # Retrieve all the files in the folder using pagination and search parameters
+    changed = 0
+    # Retrieve the files in the folder using pagination and search parameters
     while True:
-        query = f"trashed = false and parents in '{folder_id}' and mimeType='{file_type}'"
-        results = drive_service.files().list(q=query, fields="nextPageToken, files(id, name, webViewLink)",
-                                             pageToken=page_token, pageSize=1000).execute()
-        items += results.get('files', [])
+        results = service.files().list(q=query, fields="nextPageToken, files(id, name, modifiedTime, trashed)",
+                                       pageToken=page_token, pageSize=1000).execute()
+        for item in results.get('files', []):
+            changed += 1
+            if item.get('trashed'):
+                manifest['files'].pop(item['id'], None)
+            else:
+                manifest['files'][item['id']] = {'name': item['name'], 'modifiedTime': item.get('modifiedTime'),
+                                                 'sku': _file_sku(item['name'], file_type)}
         page_token = results.get('nextPageToken', None)
         if not page_token:
             break
+    manifest['synced_at'] = started
+    os.makedirs(MANIFEST_DIR, exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+    print(f"Drive folder {folder_id} ({file_type}): {changed} changed files, {len(manifest['files'])} in total")
 
     # Create a pandas DataFrame with the names and URLs of all the files
-    if not items:
+    files = manifest['files']
+    if not files:
         print('No files found in the specified folder.')
-    else:
-        file_names = [item['name'] for item in items]
-        file_ids = [item['id'] for item in items]
-        file_urls = [
-            f'https://drive.google.com/uc?id={item["id"]}' for item in items]
-        df = pd.DataFrame(
-            {'Name': file_names, 'ID': file_ids, 'URL': file_urls})
-        df.insert(0, 'SKU', '')
-        if file_type == 'image/jpeg':
-            df['SKU'] = df['Name'].str.split('-').str.get(0)
-        elif file_type == 'application/pdf':
-            df['SKU'] = df['Name'].apply(lambda x: x[:-4])
-        return df
+    return pd.DataFrame({
+        'SKU': [item['sku'] for item in files.values()],
+        'Name': [item['name'] for item in files.values()],
+        'ID': list(files),
+        'URL': [f'https://drive.google.com/uc?id={file_id}' for file_id in files],
+    }, columns=['SKU', 'Name', 'ID', 'URL'])
+
+
+def read_gdrive_many(sources, full=False):
+    """list several Google Drive folders and mime types concurrently
+
+    Args:
+        sources (list): (folder_id, file_type) pairs
+        full (boolean): optional argument. Set to True to list every file again
+
+    Returns:
+        dataframe: SKU, Name, ID and URL of the files of every source
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=DRIVE_MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(lambda source: read_gdrive(*source, full=full, service=drive_service_factory()), source)
+            for source in sources
+        ]
+        frames = [future.result() for future in futures]
+    return pd.concat(frames, axis=0, ignore_index=True)
@@ -0,0 +1,400 @@
+import asyncio
+import collections
+import concurrent.futures
+import json
+import os
+import queue
+import random
+import threading
+import time
+
+# aiohttp is imported once the engine starts, runs that never request the API skip it
+import api_archive
+import api_metrics
+from api_cache import ResponseCache, endpoint_family
+
+# Base url of the PUIG API. Point it at a local stand-in server (e.g. http://127.0.0.1:8080)
+# to exercise the whole pipeline without hitting api.puig.tv.
+API_URL = os.environ.get("PUIG_API_URL", "https://api.puig.tv").rstrip("/")
+# Global limit of in-flight requests shared by every stage
+MAX_CONCURRENCY = int(os.environ.get("PUIG_API_CONCURRENCY", "16"))
+# Limit of open connections to a single host
+MAX_PER_HOST = int(os.environ.get("PUIG_API_PER_HOST", "16"))
+# Requests a pipeline keeps submitted to the engine, the rest wait as plain urls. Each
+# submitted request holds a coroutine and a future, a few kilobytes, whether or not it runs
+SUBMIT_WINDOW = int(os.environ.get("PUIG_API_WINDOW", str(4 * MAX_CONCURRENCY)))
+# Seconds an idle keep-alive connection stays in the pool
+KEEPALIVE_TIMEOUT = 30
+# Seconds before a single request is abandoned
+REQUEST_TIMEOUT = 60
+# Set PUIG_CACHE=0 to always download full responses
+CACHE_ENABLED = os.environ.get("PUIG_CACHE", "1") != "0"
+# Attempts after the first one for transient failures (network errors, 429, 5xx)
+MAX_RETRIES = int(os.environ.get("PUIG_API_RETRIES", "4"))
+# Seconds of the first backoff, doubled on every retry and jittered
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30
+# Seconds to wait before the failed endpoints of a stage get their last chance
+DEAD_LETTER_DELAY = 30
+# Statuses worth retrying; anything else (e.g. 404) is final
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+_loop = None
+_thread = None
+_session = None
+_semaphore = None
+_lock = threading.Lock()
+cache = None
+# Raw responses of the run, see api_archive, archived with the other runs of this kind
+archive = None
+archive_kind = "adhoc"
+# Set by set_replay(), responses are then read from an archived run instead of the API
+replay = None
+# Token management, see set_authenticator()
+_authenticate = None
+_auth_header = None
+_auth_version = 0
+_auth_lock = None
+# Endpoints that still failed after the dead-letter pass of their stage
+dead_letters = []
+# Endpoints answered with 200 whose decoder raised
+decode_errors = []
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# FETCH ENGINE LIFECYCLE
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def start_engine(concurrency=None, per_host=None):
+    """Start the shared fetch engine.
+
+    The engine runs one event loop in a background thread with a single keep-alive
+    connection pool, so every stage submitting endpoints shares the same connections
+    and the same global concurrency limit. Calling it again while running is a no-op.
+
+    Args:
+        concurrency (int): optional argument. Global limit of in-flight requests
+        per_host (int): optional argument. Limit of open connections per host
+    """
+    global _loop, _thread, _session, _semaphore, _auth_lock, cache, archive
+    concurrency = concurrency or MAX_CONCURRENCY
+    per_host = per_host or MAX_PER_HOST
+    with _lock:
+        if _loop is not None:
+            return
+        import aiohttp
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name="fetch-engine", daemon=True)
+        thread.start()
+
+        async def open_session():
+            connector = aiohttp.TCPConnector(
+                limit=concurrency,
+                limit_per_host=per_host,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+            )
+            session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+            )
+            return session, asyncio.Semaphore(concurrency), asyncio.Lock()
+
+        _session, _semaphore, _auth_lock = asyncio.run_coroutine_threadsafe(open_session(), loop).result()
+        _loop, _thread = loop, thread
+        if CACHE_ENABLED and cache is None:
+            cache = ResponseCache()
+        if api_archive.ARCHIVE_ENABLED and archive is None:
+            archive = api_archive.Archive(archive_kind)
+
+
+def stop_engine(complete=True):
+    """Close the connection pool, the response cache, the archive and stop the engine thread.
+
+    Args:
+        complete (boolean): optional argument. Set to False when the run failed, its archive
+            is then not offered as the latest run to replay
+    """
+    global _loop, _thread, _session, _semaphore, cache, archive
+    with _lock:
+        if _loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(_session.close(), _loop).result()
+        _loop.call_soon_threadsafe(_loop.stop)
+        _thread.join()
+        _loop.close()
+        _loop, _thread, _session, _semaphore = None, None, None, None
+        if cache is not None:
+            print(f"Response cache: {cache.stats}")
+            cache.close()
+            cache = None
+        if archive is not None:
+            archive.close(complete)
+            archive = None
+
+
+def set_replay(run_id="latest", kind="full"):
+    """serve every request from an archived run, without network access
+
+    Args:
+        run_id (string): optional argument. Archived run, 'latest' for the newest complete one of kind
+        kind (string): optional argument. Kind of run, e.g. full, hot or shard-0-of-4
+    """
+    global replay
+    replay = api_archive.Replay(run_id, kind)
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# API TOKEN
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def set_authenticator(authenticate, auth_header=None):
+    """register the function used to log in to the API
+
+    Every request is sent with the current auth header. When the API answers 401, the
+    first request to notice calls authenticate again; concurrent requests that were
+    sent with the same expired token wait for that refresh instead of logging in too.
+
+    Args:
+        authenticate (function): called without arguments, returns the auth header dict
+        auth_header (dict): optional argument. Header obtained by an initial login
+    """
+    global _authenticate, _auth_header, _auth_version
+    _authenticate = authenticate
+    _auth_header = auth_header if auth_header is not None else authenticate()
+    _auth_version += 1
+
+
+async def _refresh_auth(version):
+    """log in again, unless another request already refreshed the token sent with version"""
+    global _auth_header, _auth_version
+    async with _auth_lock:
+        if version != _auth_version:
+            return
+        print("API token expired, logging in again")
+        _auth_header = await asyncio.get_running_loop().run_in_executor(None, _authenticate)
+        _auth_version += 1
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# REQUESTS
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def _ok(url, raw):
+    """archive a 200 response and decode it"""
+    if archive is not None:
+        archive.write(url, raw)
+    return 200, json.loads(raw)
+
+
+def _backoff(attempt, retry_after=None):
+    """seconds to sleep before a retry: jittered exponential backoff, or the server's Retry-After"""
+    if retry_after is not None and retry_after.isdigit():
+        return min(int(retry_after), BACKOFF_MAX)
+    return min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.5)
+
+
+async def _get(url, headers):
+    """GET a url through the shared pool, consulting the response cache first.
+
+    Transient failures are retried with backoff and an expired token is refreshed once.
+    The response cache (SQLite reads, commits and zlib) runs in the default executor so
+    it never blocks the event loop.
+
+    Returns:
+        tuple: (status code or None after a network error, decoded json body or None)
+    """
+    import aiohttp
+    loop = asyncio.get_running_loop()
+    family = endpoint_family(url)
+    conditional = {}
+    cached = await loop.run_in_executor(None, cache.lookup, url) if cache is not None else None
+    if cached is not None:
+        fresh, cached_body, conditional = cached
+        if fresh:
+            cache.count_hit()
+            api_metrics.record_cache(family, "hit")
+            return _ok(url, cached_body)
+    refreshed = False
+    status = None
+    for attempt in range(MAX_RETRIES + 1):
+        version = _auth_version
+        request_headers = {**(_auth_header or {}), **(headers or {}), **conditional}
+        retry_after = None
+        try:
+            async with _semaphore:
+                t0 = time.time()
+                async with _session.get(url, headers=request_headers) as response:
+                    status = response.status
+                    body = await response.read()
+                    retry_after = response.headers.get("Retry-After")
+                    etag = response.headers.get("ETag")
+                    last_modified = response.headers.get("Last-Modified")
+                api_metrics.record_request(family, status, time.time() - t0, len(body))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"{url} failed: {e!r}")
+            api_metrics.record_request(family, None, time.time() - t0)
+            status = None
+        else:
+            if status == 401 and _authenticate is not None and not refreshed:
+                await _refresh_auth(version)
+                refreshed = True
+                continue
+            if status == 304 and cached is not None:
+                await loop.run_in_executor(None, cache.touch, url)
+                api_metrics.record_cache(family, "revalidated")
+                return _ok(url, cached_body)
+            if status == 200:
+                # decoded before it is cached, a body that is not json is never served again
+                result = _ok(url, body)
+                if cache is not None:
+                    changed = await loop.run_in_executor(None, cache.store, url, body, etag, last_modified)
+                    api_metrics.record_cache(family, "miss" if changed else "unchanged")
+                return result
+            if status not in RETRY_STATUSES:
+                return status, None
+        if attempt < MAX_RETRIES:
+            api_metrics.record_retry(family)
+            await asyncio.sleep(_backoff(attempt, retry_after))
+    return status, None
+
+
+def submit(url, headers=None):
+    """submit a single GET request to the engine
+
+    Args:
+        url (string): url to request
+        headers (dict): optional argument. Request headers
+
+    Returns:
+        concurrent.futures.Future: resolves to (status code, decoded json body or None)
+    """
+    if replay is not None:
+        future = concurrent.futures.Future()
+        body = replay.lookup(url)
+        # a url missing from the archive has no answer, like a network error: it ends in
+        # dead_letters, so a replayed stage missing endpoints is not complete and deletes nothing
+        future.set_result((200, body) if body is not None else (None, None))
+        return future
+    start_engine()
+    return asyncio.run_coroutine_threadsafe(_get(url, headers), _loop)
+
+
+def fetch_json(url, headers=None):
+    """request a single url and wait for it
+
+    Args:
+        url (string): url to request
+        headers (dict): optional argument. Request headers
+
+    Returns:
+        dict: decoded json body, None if the API did not answer with 200
+    """
+    status, body = submit(url, headers).result()
+    return body
+
+
+def fetch_pipeline(endpoints, process, headers=None, follow=None):
+    """request endpoints concurrently, submitting follow-up requests as results arrive
+
+    At most SUBMIT_WINDOW endpoints are submitted to the shared engine at a time and the
+    window is topped up as results are consumed; the number of requests actually in flight
+    is bounded by the engine's concurrency limit. Responses are decoded in the calling
+    thread, in completion order. For each result of the first level, follow can queue
+    more requests straight away, so a dependent stage overlaps with the stage feeding it;
+    follow-up requests are submitted before the remaining endpoints. Endpoints that still
+    fail with a transient error after the engine's retries, or whose request raised, get
+    one more pass at the end of the stage; those failing again are added to dead_letters.
+    Only decoder errors are final.
+
+    Args:
+        endpoints (list): urls to request
+        process (function): decoder called as process(endpoint, body) for each 200 response
+        headers (dict): optional argument. Extra request headers, the auth header is added by the engine
+        follow (function): optional argument. Called as follow(endpoint, result) for each first
+            level result, returns a list of (endpoint, process) follow-up requests
+
+    Yields:
+        tuple: (process, endpoint, decoded result) for every result that is not None
+    """
+    completed = queue.Queue()
+    pending = 0
+    failed = []
+    # follow-up requests waiting for a place in the window, then the endpoints not submitted yet
+    waiting = collections.deque()
+    remaining = iter(endpoints)
+
+    def enqueue(endpoint, decoder):
+        future = submit(endpoint, headers)
+        future.add_done_callback(lambda future: completed.put((future, endpoint, decoder)))
+
+    def top_up():
+        nonlocal pending
+        while pending < SUBMIT_WINDOW:
+            if waiting:
+                enqueue(*waiting.popleft())
+            else:
+                endpoint = next(remaining, None)
+                if endpoint is None:
+                    break
+                enqueue(endpoint, process)
+            pending += 1
+
+    # main pass, then one dead-letter pass over the endpoints that kept failing
+    for last_pass in (False, True):
+        while True:
+            top_up()
+            if not pending:
+                break
+            future, endpoint, decoder = completed.get()
+            pending -= 1
+            try:
+                status, body = future.result()
+            except Exception as e:
+                # e.g. logging in again failed or a 200 answer was not json, worth another pass
+                print(f"{endpoint} failed: {e!r}")
+                failed.append((endpoint, decoder))
+                continue
+            if body is None:
+                if status is None or status == 401 or status in RETRY_STATUSES:
+                    failed.append((endpoint, decoder))
+                else:
+                    print(f"{endpoint} returned status {status}")
+                continue
+            try:
+                result = decoder(endpoint, body)
+            except Exception as e:
+                # a decoder bug fails the same way on every pass
+                print(endpoint, e)
+                decode_errors.append(endpoint)
+                continue
+            if result is None:
+                continue
+            if follow is not None and decoder is process:
+                waiting.extend(follow(endpoint, result))
+            yield decoder, endpoint, result
+        if not failed or last_pass:
+            break
+        # waiting does not bring a url into the replayed archive
+        delay = DEAD_LETTER_DELAY if replay is None else 0
+        print(f"Retrying {len(failed)} failed endpoints in {delay}s")
+        time.sleep(delay)
+        waiting.extend(failed)
+        failed = []
+    if failed:
+        print(f"{len(failed)} endpoints failed after retrying: {[endpoint for endpoint, decoder in failed[:20]]}")
+        dead_letters.extend(endpoint for endpoint, decoder in failed)
+
+
+def fetch_endpoints(endpoints, process, headers=None):
+    """request a list of endpoints concurrently and decode the responses
+
+    Args:
+        endpoints (list): urls to request
+        process (function): decoder called as process(endpoint, body) for each 200 response
+        headers (dict): optional argument. Request headers
+
+    Yields:
+        tuple: (endpoint, decoded result) for every result that is not None
+    """
+    for decoder, endpoint, result in fetch_pipeline(endpoints, process, headers):
+        yield endpoint, result
@@ -1,33 +1,58 @@
 import pandas as pd
-import requests
 import urllib
 import json
 import os
-import concurrent.futures
+import time
 from notification import send_email
 from api_data_read_write import *
+from api_fetch import API_URL, dead_letters, decode_errors, fetch_endpoints, fetch_json, fetch_pipeline, set_authenticator
+from api_records import RecordAccumulator
+from api_journal import Journal
+from api_cache import endpoint_family
+import api_journal
+from api_schema import SCHEMAS, sql_types
+import hashlib
 
 header = None
+# Set by api_main --shard i/N to (i, N): only the references of that shard are fetched
+shard = None
+# Set PUIG_DELETE_MISSING=0 to keep the rows of products, references and variations that are no
+# longer in the catalogue. They are only deleted after a stage fetched and decoded every endpoint.
+DELETE_MISSING = os.environ.get("PUIG_DELETE_MISSING", "1") != "0"
 # -------------------------------------------------------------------------------------------------------------------------------
 
 # CONNECTION TO PUIG API
 # -------------------------------------------------------------------------------------------------------------------------------
 
 
-def connect_to_api():
-    """Connect to the API."""
-    global header
+def api_login():
+    """Log in to the API.
+
+    Returns:
+        dict: request header carrying the API token
+    """
+    # only needed for the login, the other requests go through the fetch engine
+    import requests
     username = os.environ.get("PUIG_API_UNAME")
     password = os.environ.get("PUIG_API_PASS")
     # Authenticate to the API
     param = {"username": username, "password": password}
-    header = {"Content-type": "application/x-www-form-urlencoded"}
-    url = "https://api.puig.tv/es/login"
+    url = f"{API_URL}/es/login"
+    response = requests.post(
+        url, params=param, headers={"Content-type": "application/x-www-form-urlencoded"}
+    )
+    response.raise_for_status()
+    token = response.json()["data"]["token"]
+    return {"Api-Token": token}
+
+
+def connect_to_api():
+    """Connect to the API."""
+    global header
     try:
-        response = requests.post(url, params=param, headers=header)
-        if response.status_code == 200:
-            token = response.json()["data"]["token"]
-            header = {"Api-Token": token}
+        header = api_login()
+        # the fetch engine logs in again by itself when the token expires
+        set_authenticator(api_login, header)
     except Exception as e:
         send_email(
             "PUIG API script failed.",
@@ -36,54 +61,341 @@ def connect_to_api():
         raise e
 
 
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# CHECKPOINTED FETCHING
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def fetch_journaled(journal, endpoints, process):
+    """fetch_endpoints, skipping and replaying endpoints already recorded in the journal
+
+    Args:
+        journal (Journal): journal of the stage
+        endpoints (list): urls to request
+        process (function): decoder of each response
+
+    Yields:
+        tuple: (endpoint, decoded rows), journaled ones first
+    """
+    done = journal.completed()
+    wanted = set(endpoints)
+    for endpoint, rows in done.items():
+        if endpoint in wanted:
+            yield endpoint, rows
+    missing = [endpoint for endpoint in endpoints if endpoint not in done]
+    for endpoint, rows in fetch_endpoints(missing, process):
+        journal.append(endpoint, rows)
+        yield endpoint, rows
+
+
+def failure_mark():
+    """position in dead_letters and decode_errors at the start of a stage, see fetched_all()"""
+    return len(dead_letters), len(decode_errors)
+
+
+def fetched_all(mark, families):
+    """check that no endpoint of some families failed or could not be decoded since mark
+
+    Args:
+        mark (tuple): returned by failure_mark()
+        families (list): endpoint families, e.g. references/{code}
+
+    Returns:
+        boolean: True if every endpoint of those families was decoded
+    """
+    failed = dead_letters[mark[0]:] + decode_errors[mark[1]:]
+    return not any(endpoint_family(endpoint) in families for endpoint in failed)
+
+
+def finish_writers(writers, complete):
+    """write the last chunk of each writer, deleting the rows missing from a complete stage
+
+    Args:
+        writers (list): ChunkedWriter of the stage
+        complete (boolean): True if the stage fetched every endpoint, see fetched_all()
+    """
+    for writer in writers:
+        if complete and DELETE_MISSING:
+            writer.delete_missing = True
+        writer.finish()
+        if shard is not None:
+            # merge_shards only deletes missing rows once every shard fetched all of its part
+            if complete:
+                db_write(pd.DataFrame({"finished_at": [time.time()]}), complete_table(writer.table))
+            else:
+                db_drop(complete_table(writer.table))
+
+
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# SHARDED EXECUTION
+# -------------------------------------------------------------------------------------------------------------------------------
+# references are split between N processes (or machines) by a hash of their code, each
+# shard writes <table>__shard_<i>_of_<N> tables that merge_shards() folds into the final ones
+
+# Final tables written per shard, with their key and delete_missing scope while
+# some shard did not fetch every endpoint of its part
+SHARDED_TABLES = [
+    ("variants", "sku", False),
+    ("variant_details", "sku", False),
+    ("reference_bike", ["reference", "bike"], "reference"),
+]
+
+
+def shard_of(code, count):
+    """shard a reference code belongs to, the same in every process and on every machine
+
+    Args:
+        code (string): reference code
+        count (int): number of shards
+
+    Returns:
+        int: shard index, from 0 to count - 1
+    """
+    return int(hashlib.md5(str(code).encode()).hexdigest()[:8], 16) % count
+
+
+def in_shard(code):
+    """True if the reference code is handled by this process"""
+    return shard is None or shard_of(code, shard[1]) == shard[0]
+
+
+def shard_table(table, index=None, count=None):
+    """table written by a shard, the table itself when not sharded
+
+    Args:
+        table (string): final table name
+        index (int): optional argument. Shard index, defaults to the shard of this process
+        count (int): optional argument. Number of shards, defaults to the shard count of this process
+    """
+    if index is None and shard is None:
+        return table
+    if index is None:
+        index, count = shard
+    return f"{table}__shard_{index}_of_{count}"
+
+
+def complete_table(table):
+    """marker table written next to a shard table whose shard fetched every endpoint of its part"""
+    return f"{table}__complete"
+
+
+def write_table(df, table, key, delete_missing=False):
+    """upsert a reference-backed table, or replace this process' shard table of it"""
+    if shard is None:
+        db_write(df, table, mode="upsert", key=key, delete_missing=delete_missing, bulk=True)
+    else:
+        db_write(df, shard_table(table), bulk=True, dtype=sql_types(table, df))
+
+
+def table_writer(table, columns, key, transform=None, delete_missing=False, index=None):
+    """ChunkedWriter streaming rows to a reference-backed table, or to this process' shard table of it
+
+    Args:
+        table (string): final table name
+        columns (list): column names of the decoded rows
+        key (string or list): natural key column(s) of the table
+        transform (function): optional argument. Applied to the frame of each chunk
+        delete_missing (boolean or string): optional argument. See db_upsert, ignored for shard tables
+        index (string or list): optional argument. Column(s) indexed once written, ignored for shard tables
+    """
+    if shard is None:
+        return ChunkedWriter(table, columns, key=key, transform=transform, delete_missing=delete_missing, index=index)
+    return ChunkedWriter(shard_table(table), columns, key=key, mode="replace", transform=transform, schema=table)
+
+
+def merge_shards(count):
+    """upsert the tables written by the shards into the final tables, then drop them
+
+    A table is merged once every shard has written it, tables no shard wrote (e.g.
+    variants after --shard i/N --stages variant_details) are left alone. Nothing is
+    merged while some shards are missing a table, so a failed shard can be rerun before
+    merging. Rows missing from the shards are deleted (PUIG_DELETE_MISSING) only if every
+    shard fetched all of its part of the table.
+
+    Args:
+        count (int): number of shards the run was split into
+
+    Raises:
+        RuntimeError: if a table was only written by some shards, or by none at all
+    """
+    written = {
+        table: [shard_table(table, i, count) for i in range(count) if db_has_table(shard_table(table, i, count))]
+        for table, key, delete_missing in SHARDED_TABLES
+    }
+    missing = [
+        shard_table(table, i, count)
+        for table, key, delete_missing in SHARDED_TABLES
+        for i in range(count)
+        if written[table] and shard_table(table, i, count) not in written[table]
+    ]
+    if missing:
+        raise RuntimeError(f"Shards not written yet: {', '.join(missing)}")
+    merged = [(table, key, delete_missing) for table, key, delete_missing in SHARDED_TABLES if written[table]]
+    if not merged:
+        raise RuntimeError(f"No shard tables of {count} shards to merge")
+    for table, key, delete_missing in merged:
+        complete = [name for name in written[table] if db_has_table(complete_table(name))]
+        if DELETE_MISSING and len(complete) == count:
+            delete_missing = True
+        print(f"Merging {count} shards of {table}, {len(complete)} complete")
+        db_merge(written[table], table, key, delete_missing=delete_missing)
+        if table in LINK_TABLES:
+            db_create_index(table, LINK_TABLES[table][1])
+    for table, key, delete_missing in merged:
+        for name in written[table]:
+            db_drop(name)
+            db_drop(complete_table(name))
+
+
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# FITMENT LINK TABLES
+# -------------------------------------------------------------------------------------------------------------------------------
+# the delimited bikes and references columns are also written as one row per pair, so
+# "which parts fit this bike" is an index lookup instead of a LIKE scan
+
+# Parent and child column of each link table. The pair is the primary key, the child
+# column gets its own index for reverse lookups.
+LINK_TABLES = {
+    "product_reference": ("product", "reference"),
+    "product_bike": ("product", "bike"),
+    "reference_bike": ("reference", "bike"),
+}
+
+
+def link_frame(table, parents, children):
+    """one row per (parent, child) pair of a link table
+
+    Args:
+        table (string): link table name in LINK_TABLES
+        parents (series): parent ids
+        children (series): comma delimited child ids of each parent, as written by _delimited()
+
+    Returns:
+        dataframe: parent and child columns, without duplicates
+    """
+    records = RecordAccumulator(LINK_TABLES[table])
+    for parent_id, values in zip(parents, children):
+        if not isinstance(values, str) or pd.isna(parent_id):
+            continue
+        for child_id in values.split(","):
+            if child_id:
+                records.append((str(parent_id), child_id))
+    return records.to_frame(SCHEMAS[table]).drop_duplicates()
+
+
+def write_links(table, parents, children):
+    """write a link table, replacing the links of the parents present in this run
+
+    Args:
+        table (string): link table name in LINK_TABLES
+        parents (series): parent ids
+        children (series): comma delimited child ids of each parent
+    """
+    parent, child = LINK_TABLES[table]
+    links_df = link_frame(table, parents, children)
+    write_table(links_df, table, [parent, child], delete_missing=parent)
+    if shard is None:
+        db_create_index(table, child)
+
+
+def links_writer(table, columns, parents, children):
+    """streaming counterpart of write_links, fed with rows holding the parent ids and their children
+
+    Args:
+        table (string): link table name in LINK_TABLES
+        columns (list): column names of the rows
+        parents (string): column of the parent ids
+        children (string): column of the comma delimited child ids
+    """
+    parent, child = LINK_TABLES[table]
+    return table_writer(
+        table,
+        columns,
+        [parent, child],
+        transform=lambda df: link_frame(table, df[parents], df[children]),
+        delete_missing=parent,
+        index=child,
+    )
+
+
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# DECODING HELPERS
+# -------------------------------------------------------------------------------------------------------------------------------
+# fields are converted once, while decoding, so the frames need no regex clean-up afterwards
+
+
+def _delimited(values, sep=","):
+    """join a list of codes into one delimited string
+
+    Args:
+        values (list): list of scalars, a single scalar or None
+        sep (string): optional argument. Separator between the values
+
+    Returns:
+        string: e.g. "8499,8500", None if values is None
+    """
+    if values is None:
+        return None
+    if not isinstance(values, list):
+        values = [values]
+    return sep.join(str(value) for value in values if value is not None)
+
+
+def _text(value):
+    """text column value: scalars as they are, lists of scalars delimited, anything nested as json"""
+    if isinstance(value, list) and not any(isinstance(item, (dict, list)) for item in value):
+        return _delimited(value)
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return value
+
+
 # -------------------------------------------------------------------------------------------------------------------------------
 
 # API REQUESTS TO GET BIKES
 # -------------------------------------------------------------------------------------------------------------------------------
 
 
-def bikes_process_endpoint(endpoint, session):
-    try:
-        # API request to retreive list of product details
-        response_details = session.get(endpoint, headers=header)
-        if response_details.status_code == 200:
-            # data = json.loads(response_details.text)
-            # df = pd.DataFrame(data['data'])
-            df = pd.DataFrame(response_details.json()["data"])
-            # Split the references column into multiple rows
-            df = df.explode("references")
-            return df
-    except:
-        pass
+def _as_list(data):
+    """Wrap a single API record in a list so list and object payloads decode alike."""
+    return data if isinstance(data, list) else [data]
+
+
+def bikes_process_endpoint(endpoint, body):
+    rows = []
+    for bike in _as_list(body["data"]):
+        # Split the references column into multiple rows
+        references = bike.get("references") or [None]
+        if not isinstance(references, list):
+            references = [references]
+        for reference in references:
+            rows.append({**bike, "references": reference})
+    return rows
 
 
 def get_bikes():
     try:
-        session = requests.Session()
         # API request to retreive list of bikes
-        response = session.get("https://api.puig.tv/en/bikes", headers=header)
+        response = fetch_json(f"{API_URL}/en/bikes")
 
-        if response.status_code == 200:
+        if response is not None:
             # Convert list of bikes into dataframe
-            bikes_df = pd.DataFrame(response.json()["data"])
+            bikes_df = pd.DataFrame(response["data"])
             # Get a list of all the id
             ids = bikes_df["id"].tolist()
             # Append the ids to the string
-            endpoints = ["https://api.puig.tv/en/bikes/" + str(id) for id in ids]
+            endpoints = [f"{API_URL}/en/bikes/" + str(id) for id in ids]
             # endpoints = ['https://api.puig.tv/en/bikes/8499']
-            # Create an empty DataFrame to store the results
-            bikes_df = pd.DataFrame()
-            # Use a ThreadPoolExecutor to execute the process_endpoint function in parallel threads
-            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-                # Submit each API endpoint to the executor
-                futures = [
-                    executor.submit(bikes_process_endpoint, endpoint, session)
-                    for endpoint in endpoints
-                ]
-                # Iterate over each completed future and append the result to the products_df DataFrame
-                for future in concurrent.futures.as_completed(futures):
-                    df = future.result()
-                    bikes_df = pd.concat([bikes_df, df], axis=0)
+            # Collect the results column by column
+            records = RecordAccumulator()
+            # Submit each API endpoint to the shared fetch engine
+            for endpoint, rows in fetch_endpoints(endpoints, bikes_process_endpoint):
+                records.extend(rows)
+            bikes_df = records.to_frame()
             bikes_df["puig_final_name"] = (
                 bikes_df["brand"].astype(str)
                 + " "
@@ -95,14 +407,14 @@ def get_bikes():
             bikes_df["puig_final_name"] = bikes_df["puig_final_name"].str.replace(
                 "  ", " "
             )
-            db_write(bikes_df, "bikes")
+            db_write(bikes_df, "bikes", mode="swap")
             bikes_df = bikes_df.drop(
                 ["id", "brand", "model", "year", "references"], axis=1
             )
             bikes_df.drop_duplicates(
                 subset=["puig_final_name"], keep="first", inplace=True
             )
-            sh_write(bikes_df, "PUIG", "bikes")
+            sh_sync(bikes_df, "PUIG", "bikes", key="puig_final_name")
             print(bikes_df)
     except Exception as e:
         send_email(
@@ -118,48 +430,32 @@ def get_bikes():
 # -------------------------------------------------------------------------------------------------------------------------------
 
 
-def categories_process_endpoint(endpoint, session):
-    try:
-        # API request to retreive list of product details
-        response_details = session.get(endpoint, headers=header)
-        # response_details = requests.get(endpoint, headers=header)
-        if response_details.status_code == 200:
-            df = pd.DataFrame(response_details.json()["data"])
-            return df
-    except:
-        pass
+def categories_process_endpoint(endpoint, body):
+    return _as_list(body["data"])
 
 
 def get_categories():
     try:
-        session = requests.Session()
-        response = requests.get("https://api.puig.tv/en/categories", headers=header)
-        if response.status_code == 200:
+        response = fetch_json(f"{API_URL}/en/categories")
+        if response is not None:
             # Convert list of bikes into dataframe
-            categories_df = pd.DataFrame(response.json()["data"])
-            db_write(categories_df, "categories")
-            sh_write(categories_df, "PUIG", "categories")
+            categories_df = pd.DataFrame(response["data"])
+            db_write(categories_df, "categories", mode="upsert", key="id", delete_missing=True)
+            sh_sync(categories_df, "PUIG", "categories", key="id")
 
             # Get a list of all the id
             ids = categories_df["id"].tolist()
             # Append the ids to the api request url as a list of strings
-            endpoints = ["https://api.puig.tv/en/categories/" + str(id) for id in ids]
+            endpoints = [f"{API_URL}/en/categories/" + str(id) for id in ids]
             # endpoints = ['https://api.puig.tv/en/categories/200498']
-            # Create an empty DataFrame to store the results
-            subcategories_df = pd.DataFrame()
-            # Use a ThreadPoolExecutor to execute the process_endpoint function in parallel threads
-            with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-                # Submit each API endpoint to the executor
-                futures = [
-                    executor.submit(categories_process_endpoint, endpoint, session)
-                    for endpoint in endpoints
-                ]
-                # Iterate over each completed future and append the result to the products_df DataFrame
-                for future in concurrent.futures.as_completed(futures):
-                    df = future.result()
-                    subcategories_df = pd.concat([subcategories_df, df], axis=0)
-            db_write(subcategories_df, "subcategories")
-            sh_write(subcategories_df, "PUIG", "subcategories")
+            # Collect the results column by column
+            records = RecordAccumulator()
+            # Submit each API endpoint to the shared fetch engine
+            for endpoint, rows in fetch_endpoints(endpoints, categories_process_endpoint):
+                records.extend(rows)
+            subcategories_df = records.to_frame()
+            db_write(subcategories_df, "subcategories", mode="swap")
+            sh_sync(subcategories_df, "PUIG", "subcategories")
             print(subcategories_df)
     except Exception as e:
         # send_email("PUIG API script failed.",   f"Function get_categories() failed.\nNo immediate action necessary.\nThe script will auto-retry after a delay.\nDo ensure the script has executed successfully after a while.\nERROR:{e}")
@@ -170,36 +466,36 @@ def get_categories():
 
 # API REQUESTS TO GET PRODUCTS
 # -------------------------------------------------------------------------------------------------------------------------------
-# function to be executed in parallel threads
-
-
-def products_process_endpoint(endpoint, session):
-    try:
-        # API request to retreive list of product details
-        response_details = session.get(endpoint, headers=header)
-        df = pd.DataFrame(
-            columns=[
-                "id",
-                "title",
-                "description",
-                "homologation",
-                "references",
-                "bikes",
-            ]
+# function to decode each product response
+
+
+PRODUCT_DETAILS_COLUMNS = [
+    "id",
+    "title",
+    "description",
+    "homologation",
+    "references",
+    "bikes",
+    "technical",
+    "multimedia",
+]
+
+
+def products_process_endpoint(endpoint, body):
+    data = body["data"]
+    # One record, in PRODUCT_DETAILS_COLUMNS order
+    return [
+        (
+            str(data["id"]),
+            data["title"],
+            data["title"],
+            _text(data["homologation"]),
+            _delimited(data["references"]),
+            _delimited(data["bikes"]),
+            data["technical"],
+            data["multimedia"],
         )
-        if response_details.status_code == 200:
-            data = json.loads(response_details.text)["data"]
-            df.at[0, "id"] = str(data["id"])
-            df.at[0, "title"] = str(data["title"])
-            df.at[0, "description"] = str(data["title"])
-            df.at[0, "homologation"] = str(data["homologation"])
-            df.at[0, "references"] = str(data["references"])
-            df.at[0, "bikes"] = str(data["bikes"])
-            df.at[0, "technical"] = json.dumps(data["technical"])
-            df.at[0, "multimedia"] = json.dumps(data["multimedia"])
-            return df
-    except Exception as e:
-        pass
+    ]
 
 
 def get_products():
@@ -207,41 +503,31 @@ def get_products():
     # sql_query = 'select * from "products";'
     # products_backup_df = db_read(sql_query)
     # API request to retreive list of products
-    session = requests.Session()
-    response_products = requests.get("https://api.puig.tv/en/products", headers=header)
+    response_products = fetch_json(f"{API_URL}/en/products")
     # Convert list of products into dataframe
-    products_df = pd.DataFrame(response_products.json()["data"])
-    db_write(products_df, "products")
-    sh_write(products_df, "PUIG", "products")
+    products_df = pd.DataFrame(response_products["data"])
+    db_write(products_df, "products", mode="upsert", key="id", delete_missing=True)
+    sh_sync(products_df, "PUIG", "products", key="id")
     # Get a list of all the id
     ids = products_df["id"].tolist()
     # Append the ids to the api request url as a list of strings
-    endpoints = ["https://api.puig.tv/en/products/" + str(id) for id in ids]
+    endpoints = [f"{API_URL}/en/products/" + str(id) for id in ids]
     # endpoints = ['https://api.puig.tv/en/products/1100775']
-    # Create an empty DataFrame to store the results
-    product_details_df = pd.DataFrame()
-    # Use a ThreadPoolExecutor to execute the process_endpoint function in parallel threads
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        # Submit each API endpoint to the executor
-        futures = [
-            executor.submit(products_process_endpoint, endpoint, session)
-            for endpoint in endpoints
-        ]
-        # Iterate over each completed future and append the result to the products_df DataFrame
-        for future in concurrent.futures.as_completed(futures):
-            df = future.result()
-            product_details_df = pd.concat([product_details_df, df], axis=0)
-
-    # product_details_df = product_details_df.replace(
-    #    {"\[": '', "\]": '', "'": "", "\r": '', "\n": ''}, regex=True)
-    product_details_df["references"] = product_details_df["references"].replace(
-        {" ": "", "\[": "", "\]": "", "'": ""}, regex=True
-    )
-    product_details_df["bikes"] = product_details_df["bikes"].replace(
-        {" ": "", "\[": "", "\]": "", "'": ""}, regex=True
-    )
+    # Collect the results column by column
+    records = RecordAccumulator(PRODUCT_DETAILS_COLUMNS)
+    journal = Journal("product_details", api_journal.resume)
+    mark = failure_mark()
+    # Submit each API endpoint to the shared fetch engine
+    for endpoint, rows in fetch_journaled(journal, endpoints, products_process_endpoint):
+        records.extend(rows)
+    product_details_df = records.to_frame(SCHEMAS["product_details"])
     print(product_details_df)
-    db_write(product_details_df, "product_details")
+    # discontinued products are deleted once every product was fetched
+    complete = DELETE_MISSING and fetched_all(mark, ["products/{id}"])
+    db_write(product_details_df, "product_details", mode="upsert", key="id", delete_missing=complete, bulk=True)
+    write_links("product_reference", product_details_df["id"], product_details_df["references"])
+    write_links("product_bike", product_details_df["id"], product_details_df["bikes"])
+    journal.clear()
     # sh_write(product_details_df, "PUIG", "product_details")
 
 
@@ -249,17 +535,17 @@ def get_products():
 
 # API REQUESTS TO GET REFERENCE VARIANTS
 # -------------------------------------------------------------------------------------------------------------------------------
-# function to be executed in parallel threads
+# function to decode each reference response
 
 
 def get_references():
     try:
         # API request to retreive list of references
-        response = requests.get("https://api.puig.tv/en/references", headers=header)
+        response = fetch_json(f"{API_URL}/en/references")
 
-        if response.status_code == 200:
+        if response is not None:
             # Convert list of references into dataframe
-            references_df = pd.DataFrame(response.json()["data"])
+            references_df = pd.DataFrame(response["data"])
             references_df.rename(columns={0: "references"}, inplace=True)
             # Droping known sku with error
             references_df.drop(
@@ -279,148 +565,147 @@ def get_references():
         raise e
 
 
-def variants_process_endpoint(endpoint, session):
-    try:
-        # API request to retreive list of product details
-        response_details = session.get(endpoint, headers=header)
-        df = pd.DataFrame(
-            columns=[
-                "reference",
-                "product",
-                "variations",
-                "title",
-                "description",
-                "bikes",
-                "aerotest",
-                "comparative",
-                "instructions",
-            ]
+VARIANTS_COLUMNS = [
+    "reference",
+    "product",
+    "variations",
+    "title",
+    "description",
+    "bikes",
+    "aerotest",
+    "comparative",
+    "instructions",
+]
+
+
+def variants_process_endpoint(endpoint, body):
+    data = body["data"]
+    if data["groups"] == None:
+        title = None
+        description = None
+    else:
+        title = _text(data["groups"][0]["title"])
+        description = _text(data["groups"][0]["description"])
+    variations = data["variations"]
+    if not isinstance(variations, list):
+        variations = [variations]
+    # One record per variation, in VARIANTS_COLUMNS order
+    return [
+        (
+            str(data["code"]),
+            data["product"],
+            variation,
+            title,
+            description,
+            _delimited(data["bikes"]),
+            _text(data["aerotest"]),
+            _text(data["comparative"]),
+            _text(data["instructions"]),
         )
-        if response_details.status_code == 200:
-            data = json.loads(response_details.text)["data"]
-            df.at[0, "reference"] = str(data["code"])
-            df.at[0, "product"] = data["product"]
-            df.at[0, "variations"] = data["variations"]
-            if data["groups"] == None:
-                df.at[0, "title"] = None
-                df.at[0, "description"] = None
-            else:
-                df.at[0, "title"] = str(data["groups"][0]["title"])
-                df.at[0, "description"] = str(data["groups"][0]["description"])
-            df.at[0, "bikes"] = str(data["bikes"])
-            df.at[0, "aerotest"] = data["aerotest"]
-            df.at[0, "comparative"] = data["comparative"]
-            df.at[0, "instructions"] = data["instructions"]
-            df = df.explode("variations")
-            return df
-    except Exception as e:
-        print(str(data["code"]), str(data["groups"]), type(data["groups"]))
-        raise e
+        for variation in variations or [None]
+    ]
 
 
-def get_variants():
-    session = requests.Session()
+def references_endpoints():
+    """urls of every reference to request"""
     ref_df = get_references()
     # Get a list of all the id
-    refs = ref_df["references"].tolist()
-    endpoints = ["https://api.puig.tv/en/references/" + str(ref) for ref in refs]
-    # endpoints = ['https://api.puig.tv/en/references/0013']
-    # Create an empty DataFrame to store the results
-    variants_df = pd.DataFrame()
-    # Use a ThreadPoolExecutor to execute the process_endpoint function in parallel threads
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        # Submit each API endpoint to the executor
-        futures = [
-            executor.submit(variants_process_endpoint, endpoint, session)
-            for endpoint in endpoints
-        ]
-        # Iterate over each completed future and append the result to the products_df DataFrame
-        for future in concurrent.futures.as_completed(futures):
-            df = future.result()
-            variants_df = pd.concat([variants_df, df], axis=0)
-    variants_df["bikes"] = variants_df["bikes"].str.replace(" ", "")
-    variants_df = variants_df.replace(
-        {"\[": "", "\]": "", "\{": "", "\}": "", "'": "", "\r": "", "\n": ""},
-        regex=True,
+    refs = [ref for ref in ref_df["references"].tolist() if in_shard(ref)]
+    if shard is not None:
+        print(f"Shard {shard[0]}/{shard[1]}: {len(refs)} of {len(ref_df)} references")
+    return [f"{API_URL}/en/references/" + str(ref) for ref in refs]
+    # return ['https://api.puig.tv/en/references/0013']
+
+
+def get_variants():
+    endpoints = references_endpoints()
+    # Write the results in chunks as they arrive
+    writers = variants_writers()
+    journal = Journal(shard_table("variants"), api_journal.resume)
+    # Submit each API endpoint to the shared fetch engine
+    mark = failure_mark()
+    for endpoint, rows in fetch_journaled(journal, endpoints, variants_process_endpoint):
+        for writer in writers:
+            writer.extend(rows)
+    finish_writers(writers, fetched_all(mark, ["references/{code}"]))
+    journal.clear()
+
+
+def variants_chunk(variants_df):
+    """add the sku column to a chunk of the variants table
+
+    Args:
+        variants_df (dataframe): rows returned by variants_process_endpoint, modified in place
+    """
+    variants_df.insert(
+        0, "sku", variants_df["reference"] + variants_df["variations"].astype("string")
     )
-    variants_df.insert(0, "sku", variants_df["reference"] + variants_df["variations"])
     # print(variants_df)
-    db_write(variants_df, "variants")
-    # sh_write(product_details_df, "PUIG", "product_details")
+    return variants_df
+
+
+def variants_writers():
+    """writers of the variants table and of its reference_bike links, fed with the same rows"""
+    return [
+        table_writer("variants", VARIANTS_COLUMNS, "sku", transform=variants_chunk),
+        links_writer("reference_bike", VARIANTS_COLUMNS, "reference", "bikes"),
+    ]
 
 
 # -------------------------------------------------------------------------------------------------------------------------------
 
 # API REQUESTS TO GET VARIANT SPECIFICATIONS
 # -------------------------------------------------------------------------------------------------------------------------------
-# function to be executed in parallel threads
-
-
-def variantdetails_process_endpoint(endpoint, session):
-    try:
-        # API request to retreive list of product details
-        response_details = requests.get(endpoint, headers=header)
-        if response_details.status_code == 200:
-            data = json.loads(response_details.text)["data"]
-            # print(data)
-            # Creating empty dataframe
-            df = pd.DataFrame(
-                columns=[
-                    "reference",
-                    "colour",
-                    "stock",
-                    "stock_prevision",
-                    "outdated",
-                    "weight",
-                    "height",
-                    "width",
-                    "depth",
-                    "barcode",
-                    "alternative",
-                    "pvp",
-                    "pvp_recomended",
-                    "multimedia",
-                    "origin",
-                    "hs_code",
-                ]
-            )
-            # Inserting appropriate data to dataframe
-            df.at[0, "reference"] = str(data["code"])
-            df.at[0, "colour"] = str(data["colour"])
-            df.at[0, "stock"] = str(data["stock"])
-            df.at[0, "stock_prevision"] = str(data["stock_prevision"])
-            df.at[0, "outdated"] = str(data["outdated"])
-            df.at[0, "weight"] = str(data["weight"])
-            df.at[0, "height"] = str(data["height"])
-            df.at[0, "width"] = str(data["width"])
-            df.at[0, "depth"] = str(data["depth"])
-            df.at[0, "barcode"] = str(data["barcode"])
-            df.at[0, "alternative"] = str(data["alternative"])
-            df.at[0, "pvp"] = str(data["pvp"])
-            df.at[0, "pvp_recomended"] = str(data["pvp_recomended"])
-            df.at[0, "multimedia"] = str(data["multimedia"])
-            df.at[0, "origin"] = str(data["origin"])
-            df.at[0, "hs_code"] = str(data["hs_code"])
-            # df.at[0, 'images'] = str(data['multimedia']['images'])
-            # df.at[0, 'videos'] = str(data['multimedia']['videos'])
-            # df.at[0, 'onbike'] = str(data['multimedia']['onbike'])[1:-1]
-            return df
-    except Exception as e:
-        """
-        if response_details.status_code != 200:
-            print(
-                f"The API returned an error code: {response_details.status_code}.\nReconnecting to API...")
-            connect_to_api()
-            print("Reconnected to API.")
-            return variantdetails_process_endpoint(endpoint, session)
-        else:"""
-        # print(str(data['code']))
-        print(endpoint, e)
-        pass
+# function to decode each variant response
+
+
+VARIANT_DETAILS_COLUMNS = [
+    "reference",
+    "colour",
+    "stock",
+    "stock_prevision",
+    "outdated",
+    "weight",
+    "height",
+    "width",
+    "depth",
+    "barcode",
+    "alternative",
+    "pvp",
+    "pvp_recomended",
+    "multimedia",
+    "origin",
+    "hs_code",
+]
+
+
+def variantdetails_process_endpoint(endpoint, body):
+    data = body["data"]
+    # print(data)
+    # One record, in VARIANT_DETAILS_COLUMNS order
+    return [
+        (
+            str(data["code"]),
+            str(data["colour"]),
+            data["stock"],
+            data["stock_prevision"],
+            data["outdated"],
+            data["weight"],
+            data["height"],
+            data["width"],
+            data["depth"],
+            _text(data["barcode"]),
+            _text(data["alternative"]),
+            data["pvp"],
+            data["pvp_recomended"],
+            data["multimedia"],
+            _text(data["origin"]),
+            _text(data["hs_code"]),
+        )
+    ]
 
 
 def get_variant_details():
-    session = requests.Session()
     # Backing current data from the database
     # sql_query = 'select * from "variants";'
     # variantspecs_backup_df = db_read(sql_query)
@@ -430,62 +715,173 @@ def get_variant_details():
 
     refs = variants_df["sku"].tolist()
     endpoints = [
-        "https://api.puig.tv/en/references/" + str(ref[:-1]) + "/" + str(ref[-1])
+        f"{API_URL}/en/references/" + str(ref[:-1]) + "/" + str(ref[-1])
         for ref in refs
+        if in_shard(ref[:-1])
     ]
     # endpoints = ['https://api.puig.tv/en/references/3755/N', 'https://api.puig.tv/en/references/3755/H', 'https://api.puig.tv/en/references/3755/W']
-    # Create an empty DataFrame to store the results
-    variant_details_df = pd.DataFrame()
-    # Use a ThreadPoolExecutor to execute the process_endpoint function in parallel threads
-    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
-        # Submit each API endpoint to the executor
-        futures = [
-            executor.submit(variantdetails_process_endpoint, endpoint, session)
-            for endpoint in endpoints
-        ]
-        # Iterate over each completed future and append the result to the products_df DataFrame
-        for future in concurrent.futures.as_completed(futures):
-            df = future.result()
-            variant_details_df = pd.concat([variant_details_df, df], axis=0)
-    # Inserting sku column, combining ref sku & colour
-    variant_details_df.insert(
-        0, "sku", variant_details_df["reference"] + variant_details_df["colour"]
-    )
-    # Converting datatype of column (string to float)
-    variant_details_df["pvp_recomended"] = variant_details_df["pvp_recomended"].astype(
-        float
-    )
-    # Converting datatype of column (string to float)
-    variant_details_df["pvp"] = variant_details_df["pvp"].astype(float)
+    # Write the results in chunks as they arrive
+    writer = variant_details_writer()
+    journal = Journal(shard_table("variant_details"), api_journal.resume)
+    mark = failure_mark()
+    # Submit each API endpoint to the shared fetch engine
+    for endpoint, rows in fetch_journaled(journal, endpoints, variantdetails_process_endpoint):
+        writer.extend(rows)
+    finish_writers([writer], fetched_all(mark, ["references/{code}/{colour}"]))
+    journal.clear()
+
+
+def add_prices(variant_details_df):
+    """add the cost and rrp columns derived from pvp
+
+    Args:
+        variant_details_df (dataframe): variant details with a pvp column, modified in place
+    """
+    # Converting datatype of column (nullable float, missing prices stay NA)
+    variant_details_df["pvp"] = variant_details_df["pvp"].astype("Float64")
     # Calculating Cost
     variant_details_df["cost"] = variant_details_df["pvp"] * 0.495
     # Calculating RRP
     variant_details_df["rrp"] = round(variant_details_df["pvp"] * 1.21 * 0.842) - 0.01
+
+
+def variant_details_chunk(variant_details_df):
+    """add the sku, cost and rrp columns to a chunk of the variant_details table
+
+    Args:
+        variant_details_df (dataframe): rows returned by variantdetails_process_endpoint, modified in place
+    """
+    # Inserting sku column, combining ref sku & colour
+    variant_details_df.insert(
+        0,
+        "sku",
+        variant_details_df["reference"] + variant_details_df["colour"].astype("string"),
+    )
+    add_prices(variant_details_df)
     # print(variant_details_df)
-    # variant_details_df['onbike'] = variant_details_df['onbike'].to_json()
-    # variant_details_df['onbike'] = json.dumps(variant_details_df['onbike'])
-    variant_details_df = variant_details_df.replace(
-        {"'": '"', "None": "null"}, regex=True
+    return variant_details_df
+
+
+def variant_details_writer():
+    """writer of the variant_details table"""
+    return table_writer("variant_details", VARIANT_DETAILS_COLUMNS, "sku", transform=variant_details_chunk)
+
+
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# PIPELINED VARIANTS AND VARIANT SPECIFICATIONS
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def variant_details_follow(endpoint, rows):
+    """queue a variant detail request for every variation of a decoded reference
+
+    Args:
+        endpoint (string): reference url the rows were decoded from
+        rows (list): rows returned by variants_process_endpoint
+
+    Returns:
+        list: (endpoint, process) pairs to submit
+    """
+    return [
+        (f"{API_URL}/en/references/{row[0]}/{row[2]}", variantdetails_process_endpoint)
+        for row in rows
+        if row[2] is not None
+    ]
+
+
+def get_variants_and_details(endpoints=None):
+    """Fetch references and variant specifications as one producer/consumer pipeline.
+
+    Each variation decoded from /references/{code} is queued as a
+    /references/{code}/{colour} request straight away, so both stages overlap and
+    variant_details no longer has to read the variants table back from the database.
+
+    Args:
+        endpoints (list): optional argument. Reference urls, as returned by references_endpoints()
+    """
+    if endpoints is None:
+        endpoints = references_endpoints()
+    # Write both tables in chunks as the results arrive
+    variants = variants_writers()
+    variant_details = variant_details_writer()
+    journal = Journal(shard_table("variants_and_details"), api_journal.resume)
+    done = journal.completed()
+    mark = failure_mark()
+    # Replay the journal, then fetch the details of journaled references that are still missing
+    details_missing = []
+    for endpoint, rows in done.items():
+        if endpoint_family(endpoint) == "references/{code}":
+            for writer in variants:
+                writer.extend(rows)
+            details_missing += [
+                detail for detail, process in variant_details_follow(endpoint, rows) if detail not in done
+            ]
+        else:
+            variant_details.extend(rows)
+    for endpoint, rows in fetch_endpoints(details_missing, variantdetails_process_endpoint):
+        journal.append(endpoint, rows)
+        variant_details.extend(rows)
+    missing = [endpoint for endpoint in endpoints if endpoint not in done]
+    for process, endpoint, rows in fetch_pipeline(
+        missing, variants_process_endpoint, follow=variant_details_follow
+    ):
+        journal.append(endpoint, rows)
+        if process is variants_process_endpoint:
+            for writer in variants:
+                writer.extend(rows)
+        else:
+            variant_details.extend(rows)
+    references_complete = fetched_all(mark, ["references/{code}"])
+    finish_writers(variants, references_complete)
+    finish_writers(
+        [variant_details], references_complete and fetched_all(mark, ["references/{code}/{colour}"])
     )
-    print("variant_details_complete")
-    connect_to_db()
-    db_write(variant_details_df, "variant_details")
-    variant_details_df.info(memory_usage="deep")
-    """variantspecs_df = variantspecs_df.fillna('0')
-    variantspecs_df = variantspecs_df.replace(
-        {"\[": '', "\]": '', "'": "", "\r": '', "\n": ''}, regex=True)
-    variantspecs_df['ref_sku'] = variantspecs_df.sku.str[:-1]
-    variantspecs_df["pvp"] = variantspecs_df["pvp"].astype(float)
-    variantspecs_df['rrp'] = round(variantspecs_df['pvp']*1.21*0.88)-0.01
-    # Concatinating the current data with the new data
-    variantspecs_df = pd.concat(
-        [variantspecs_backup_df, variantspecs_df], axis=0)
-    # Droping duplicated products by id
-    # This is done as occationally api calls fail and the products drops completly from the database
-    variantspecs_df.drop_duplicates(subset=['sku'], keep="last", inplace=True)
-    print("variantspecs")
-    print("finished")"""
-
-
-# ALTER TABLE variant_details
-# ALTER COLUMN multimedia TYPE JSONB USING multimedia::jsonb;
+    journal.clear()
+
+
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# FAST REFRESH OF STOCK AND PRICES
+# -------------------------------------------------------------------------------------------------------------------------------
+# stock and price change many times a day, everything else in variant_details rarely does
+
+
+VARIANT_STOCK_COLUMNS = ["reference", "colour", "stock", "stock_prevision", "pvp"]
+
+
+def variantstock_process_endpoint(endpoint, body):
+    data = body["data"]
+    # One record, in VARIANT_STOCK_COLUMNS order
+    return [
+        (
+            str(data["code"]),
+            str(data["colour"]),
+            data["stock"],
+            data["stock_prevision"],
+            data["pvp"],
+        )
+    ]
+
+
+def refresh_variant_stock():
+    """Refresh stock, stock_prevision and prices of the variants already in variant_details.
+
+    Only the volatile columns are decoded and patched in the database; the bikes,
+    categories, products and variants stages are not needed.
+    """
+    sql_query = "select reference, colour from variant_details;"
+    keys_df = db_read(sql_query)
+    endpoints = [
+        f"{API_URL}/en/references/{reference}/{colour}"
+        for reference, colour in zip(keys_df["reference"], keys_df["colour"])
+    ]
+    records = RecordAccumulator(VARIANT_STOCK_COLUMNS)
+    for endpoint, rows in fetch_endpoints(endpoints, variantstock_process_endpoint):
+        records.extend(rows)
+    stock_df = records.to_frame(SCHEMAS["variant_details"])
+    stock_df.insert(0, "sku", stock_df["reference"] + stock_df["colour"].astype("string"))
+    stock_df = stock_df.drop(["reference", "colour"], axis=1)
+    add_prices(stock_df)
+    db_update_columns(stock_df, "variant_details", key="sku", bulk=True)
+
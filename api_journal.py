@@ -0,0 +1,82 @@
+import json
+import os
+
+from api_cache import CACHE_DIR
+
+# Directory holding one journal per stage
+JOURNAL_DIR = os.path.join(CACHE_DIR, "journal")
+# Set by api_main --resume, journals left by an interrupted run are then reused
+resume = False
+# Journals opened in this process and not cleared yet, by path
+_open = {}
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# STAGE JOURNAL
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+class Journal:
+    """Append-only record of the endpoints a stage has already fetched and decoded.
+
+    Each line holds one endpoint and its decoded rows, written as soon as the response
+    is decoded. A rerun with resume enabled reloads those rows and only fetches the
+    endpoints that are missing. The journal is removed once the stage's final write
+    succeeds. A stage retried within the same run always resumes from the journal its
+    failed attempt left.
+
+    Args:
+        stage (string): stage name, used as the journal file name
+        resume (boolean): optional argument. Set to True to keep the entries of a previous run
+    """
+
+    def __init__(self, stage, resume=False):
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        self.path = os.path.join(JOURNAL_DIR, f"{stage}.jsonl")
+        self._completed = {}
+        torn = False
+        previous = _open.pop(self.path, None)
+        if previous is not None:
+            # retry of a stage that failed earlier in this run
+            previous._file.close()
+            resume = True
+        if resume and os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    torn = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # line cut short by the interruption
+                        continue
+                    self._completed[entry["endpoint"]] = [
+                        row if isinstance(row, dict) else tuple(row) for row in entry["rows"]
+                    ]
+            print(f"Resuming {stage}: {len(self._completed)} endpoints already fetched")
+        self._file = open(self.path, "a" if resume else "w", encoding="utf-8")
+        if torn:
+            self._file.write("\n")
+        _open[self.path] = self
+
+    def completed(self):
+        """endpoints fetched by a previous run
+
+        Returns:
+            dict: decoded rows by endpoint
+        """
+        return self._completed
+
+    def append(self, endpoint, rows):
+        """record a decoded endpoint
+
+        Args:
+            endpoint (string): url that was fetched
+            rows (list): rows decoded from the response
+        """
+        self._file.write(json.dumps({"endpoint": endpoint, "rows": rows}) + "\n")
+        self._file.flush()
+
+    def clear(self):
+        """remove the journal after the stage has been written"""
+        _open.pop(self.path, None)
+        self._file.close()
+        os.remove(self.path)
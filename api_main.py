@@ -1,35 +1,187 @@
-from api_functions import *
-from api_data_read_write import *
+import argparse
 import time
-import asyncio
-import threading
 
+# Every stage of the ETL: function of api_functions, stages whose results it takes as
+# arguments, retries, timeout in seconds and the connections it needs.
+# api_functions (pandas, sqlalchemy, ...) is only imported once a stage runs.
+STAGES = {
+    "bikes": ("get_bikes", [], 1, 3600, {"db", "sheets", "api"}),
+    "categories": ("get_categories", [], 1, 3600, {"db", "sheets", "api"}),
+    "products": ("get_products", [], 1, 3600, {"db", "sheets", "api"}),
+    "references": ("references_endpoints", [], 2, 600, {"api"}),
+    "variants": ("get_variants_and_details", ["references"], 1, 8 * 3600, {"db", "api"}),
+    # variant_details alone, reading the skus of the variants table
+    "variant_details": ("get_variant_details", [], 1, 8 * 3600, {"db", "api"}),
+    "variant_stock": ("refresh_variant_stock", [], 1, 900, {"db", "api"}),
+    # folds the tables written by --shard runs into the final tables, see --merge
+    "merge": ("merge_shards", [], 1, 8 * 3600, {"db"}),
+}
+# Stages of a full run
+DEFAULT_STAGES = ["bikes", "categories", "products", "references", "variants"]
+# Stages that can be split with --shard, by reference code
+SHARDABLE_STAGES = ["references", "variants", "variant_details"]
 
-if __name__ == '__main__':
-    t0 = time.time()
-    connect_to_db()
-    connect_to_serv_acc()
-    connect_to_api()
-
-    get_bikes()
-    get_categories()
-    get_products()
-    get_variants()
-    get_variant_details()
-    #test_get_variant_details()
+
+def _stage_function(name, *args):
+    """function running a stage, importing api_functions on first call"""
+    def run(**inputs):
+        import api_functions
+        return getattr(api_functions, name)(*inputs.values(), *args)
+    return run
+
+
+def parse_shard(value):
+    """'i/N' command line value to (i, N)"""
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {value}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"shard index must be between 0 and {count - 1}")
+    return index, count
+
+
+def select_stages(names):
+    """requested stages plus the stages they take inputs from
+
+    Args:
+        names (list): stage names
+
+    Returns:
+        list: stage names in STAGES order
+    """
+    unknown = [name for name in names if name not in STAGES]
+    if unknown:
+        raise ValueError(f"Unknown stages {', '.join(unknown)}, choose among {', '.join(STAGES)}")
+    selected = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in selected:
+            selected.add(name)
+            pending += STAGES[name][1]
+    return [name for name in STAGES if name in selected]
+
+
+def run_kind(names, shard=None):
+    """kind of run the archive of a run is kept and replayed with
+
+    Args:
+        names (list): selected stage names
+        shard (tuple): optional argument. (i, N) of a --shard run
+
+    Returns:
+        string: shard-i-of-N, hot, full if every default stage runs, partial otherwise
     """
-    all_threads = []
-    # Create a thread for each function
-    for func in [get_categories, get_references]:
-        t = threading.Thread(target=func)
-        all_threads.append(t)
-    # Start all the threads
-    for t in all_threads:
-        t.start()
-    # Wait for all threads to finish
-    for t in all_threads:
-        t.join()
+    if shard:
+        return f"shard-{shard[0]}-of-{shard[1]}"
+    if names == ["variant_stock"]:
+        return "hot"
+    if all(name in names for name in DEFAULT_STAGES):
+        return "full"
+    return "partial"
+
+
+def main(argv=None):
+    """run the ETL
+
+    Args:
+        argv (list): optional argument. Command line arguments, defaults to sys.argv
     """
+    parser = argparse.ArgumentParser(description="PUIG API to database and Google Sheets ETL")
+    parser.add_argument("--stages",
+                        help=f"comma separated stages to run (default: {','.join(DEFAULT_STAGES)}), "
+                             f"among {', '.join(STAGES)}; the stages they depend on are added")
+    parser.add_argument("--resume", action="store_true",
+                        help="reuse the endpoints fetched by an interrupted run and only fetch what is missing")
+    parser.add_argument("--hot", action="store_true",
+                        help="only refresh stock, stock_prevision and prices of the existing variant_details rows "
+                             "(same as --stages variant_stock)")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="only fetch the references of shard i out of N and write them to the shard's own "
+                             f"tables (stages {', '.join(SHARDABLE_STAGES)}, default variants)")
+    parser.add_argument("--merge", type=int, metavar="N",
+                        help="merge the tables written by the N shards into the final tables (same as --stages merge)")
+    parser.add_argument("--replay", nargs="?", const="latest", metavar="RUN",
+                        help="rerun the decoders and sinks on the responses archived by a previous run "
+                             "(default: the latest complete full run, or of the same shard or --hot) "
+                             "instead of requesting the API")
+    args = parser.parse_args(argv)
+    if args.merge:
+        names = ["merge"]
+    elif args.hot:
+        names = ["variant_stock"]
+    elif args.stages:
+        names = [name.strip() for name in args.stages.split(",") if name.strip()]
+    elif args.shard:
+        names = ["variants"]
+    else:
+        names = DEFAULT_STAGES
+    try:
+        names = select_stages(names)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.shard and any(name not in SHARDABLE_STAGES for name in names):
+        parser.error(f"--shard only applies to the stages {', '.join(SHARDABLE_STAGES)}")
+    if "merge" in names and not args.merge:
+        parser.error("the merge stage needs --merge N")
+
+    t0 = time.time()
+    import api_journal
+    import api_metrics
+    from api_scheduler import Stage, run_stages
+    api_journal.resume = args.resume
+
+    # Only open the connections the selected stages use
+    needed = set().union(*(STAGES[name][4] for name in names))
+    if "db" in needed or "sheets" in needed:
+        import api_data_read_write
+        if "db" in needed:
+            api_data_read_write.connect_to_db()
+        if "sheets" in needed:
+            api_data_read_write.connect_to_serv_acc()
+    # api_fetch (aiohttp) is only imported by runs requesting the API or replaying it
+    api_fetch = None
+    if "api" in needed or args.replay:
+        import api_fetch
+        api_fetch.archive_kind = run_kind(names, args.shard)
+    if args.replay:
+        # partial runs replay the latest full run, which archived every endpoint
+        kind = api_fetch.archive_kind if api_fetch.archive_kind != "partial" else "full"
+        api_fetch.set_replay(args.replay, kind)
+    if "api" in needed:
+        import api_functions
+        api_functions.shard = args.shard
+        if not args.replay:
+            api_functions.connect_to_api()
+    print(f"Running {', '.join(names)} (started in {time.time() - t0:.2f}s)")
+
+    # Stages declare the stages they depend on and start as soon as those finish
+    stages = []
+    for name in names:
+        function, inputs, retries, timeout, connections = STAGES[name]
+        args_of_stage = [args.merge] if name == "merge" else []
+        stages.append(Stage(name, _stage_function(function, *args_of_stage),
+                            inputs=inputs, retries=retries, timeout=timeout))
+    completed = False
+    try:
+        run_stages(stages)
+        completed = True
+    finally:
+        if api_fetch is not None:
+            api_fetch.stop_engine(completed)
+        if "sheets" in needed:
+            api_data_read_write.flush_sheets()
+        if api_fetch is not None and api_fetch.dead_letters:
+            print(f"{len(api_fetch.dead_letters)} endpoints could not be fetched this run")
+        if api_fetch is not None and api_fetch.replay is not None:
+            print(f"Replay: {api_fetch.replay.stats}")
+        api_metrics.write_report(suffix=f"-shard{args.shard[0]}of{args.shard[1]}" if args.shard else "")
+    #test_get_variant_details()
 
     t1 = time.time()
     print(f"Execution Time: {(t1-t0)/60} minutes")
+
+
+if __name__ == '__main__':
+    main()
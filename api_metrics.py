@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+import time
+
+from api_cache import CACHE_DIR
+
+# Directory receiving the JSON run reports and the Prometheus textfile
+METRICS_DIR = os.environ.get("PUIG_METRICS_DIR", os.path.join(CACHE_DIR, "metrics"))
+# Upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_lock = threading.Lock()
+_started = time.time()
+# Counters by endpoint family, see _family()
+_requests = {}
+# Duration, status and attempts by stage name
+_stages = {}
+# Rows and seconds by (sink, table)
+_writes = {}
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# RECORDING
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def _family(family):
+    """counters of an endpoint family, created on first use (call with _lock held)"""
+    if family not in _requests:
+        _requests[family] = {
+            "requests": 0,
+            "statuses": {},
+            "bytes": 0,
+            "retries": 0,
+            "cache": {"hit": 0, "revalidated": 0, "unchanged": 0, "miss": 0},
+            "latency_buckets": [0] * len(LATENCY_BUCKETS),
+            "latency_sum": 0.0,
+        }
+    return _requests[family]
+
+
+def record_request(family, status, latency, size=0):
+    """record one HTTP attempt
+
+    Args:
+        family (string): endpoint family, see api_cache.endpoint_family()
+        status (int): status code, None after a network error
+        latency (float): seconds until the body was read
+        size (int): optional argument. Bytes of the response body
+    """
+    with _lock:
+        counters = _family(family)
+        counters["requests"] += 1
+        status = "error" if status is None else str(status)
+        counters["statuses"][status] = counters["statuses"].get(status, 0) + 1
+        counters["bytes"] += size
+        counters["latency_sum"] += latency
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                counters["latency_buckets"][i] += 1
+
+
+def record_retry(family):
+    """record a retry of a request of an endpoint family"""
+    with _lock:
+        _family(family)["retries"] += 1
+
+
+def record_cache(family, result):
+    """record a response cache lookup
+
+    Args:
+        family (string): endpoint family
+        result (string): 'hit' (served from cache), 'revalidated' (304), 'unchanged'
+            (200 with the cached content) or 'miss' (new or changed content)
+    """
+    with _lock:
+        _family(family)["cache"][result] += 1
+
+
+def record_stage(name, status, duration, attempts):
+    """record the outcome of a scheduled stage"""
+    with _lock:
+        _stages[name] = {"status": status, "duration": duration, "attempts": attempts}
+
+
+def record_write(sink, table, rows, seconds):
+    """record rows written by a sink
+
+    Args:
+        sink (string): e.g. 'db' or 'sheets'
+        table (string): table or worksheet written
+        rows (int): number of rows written
+        seconds (float): time spent writing
+    """
+    with _lock:
+        counters = _writes.setdefault((sink, table), {"rows": 0, "seconds": 0.0, "writes": 0})
+        counters["rows"] += rows
+        counters["seconds"] += seconds
+        counters["writes"] += 1
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# EXPORT
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def report():
+    """everything recorded so far
+
+    Returns:
+        dict: run start and duration, request counters by endpoint family, stages and writes
+    """
+    with _lock:
+        return {
+            "started": _started,
+            "duration": time.time() - _started,
+            "latency_buckets": list(LATENCY_BUCKETS),
+            "requests": json.loads(json.dumps(_requests)),
+            "stages": {name: dict(stage) for name, stage in _stages.items()},
+            "writes": [
+                {"sink": sink, "table": table, **counters} for (sink, table), counters in _writes.items()
+            ],
+        }
+
+
+def _label(value):
+    """escape a Prometheus label value"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def prometheus_text(data=None):
+    """metrics in the Prometheus text exposition format
+
+    Args:
+        data (dict): optional argument. Report as returned by report()
+
+    Returns:
+        string: textfile contents
+    """
+    data = data or report()
+    lines = []
+
+    def metric(name, kind, help_text, samples, suffix=""):
+        if kind:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{_label(label)}"' for key, label in labels.items())
+            lines.append(f"{name}{suffix}{{{label_text}}} {value}" if label_text else f"{name}{suffix} {value}")
+
+    requests = data["requests"]
+    histogram = []
+    for family, counters in requests.items():
+        for bound, count in zip(data["latency_buckets"], counters["latency_buckets"]):
+            histogram.append(({"family": family, "le": bound}, count))
+        histogram.append(({"family": family, "le": "+Inf"}, counters["requests"]))
+    metric("puig_api_request_duration_seconds", "histogram", "Latency of API requests.", histogram, "_bucket")
+    metric("puig_api_request_duration_seconds", None, None,
+           [({"family": family}, counters["latency_sum"]) for family, counters in requests.items()], "_sum")
+    metric("puig_api_request_duration_seconds", None, None,
+           [({"family": family}, counters["requests"]) for family, counters in requests.items()], "_count")
+    metric("puig_api_responses_total", "counter", "API responses by status code.",
+           [({"family": family, "status": status}, count)
+            for family, counters in requests.items() for status, count in counters["statuses"].items()])
+    metric("puig_api_response_bytes_total", "counter", "Bytes of API response bodies.",
+           [({"family": family}, counters["bytes"]) for family, counters in requests.items()])
+    metric("puig_api_retries_total", "counter", "API requests retried.",
+           [({"family": family}, counters["retries"]) for family, counters in requests.items()])
+    metric("puig_api_cache_total", "counter", "Response cache lookups by result.",
+           [({"family": family, "result": result}, count)
+            for family, counters in requests.items() for result, count in counters["cache"].items()])
+    metric("puig_stage_duration_seconds", "gauge", "Duration of each stage of the last run.",
+           [({"stage": name}, stage["duration"]) for name, stage in data["stages"].items()])
+    metric("puig_stage_success", "gauge", "1 if the stage completed in the last run.",
+           [({"stage": name}, int(stage["status"] == "done")) for name, stage in data["stages"].items()])
+    metric("puig_stage_attempts", "gauge", "Attempts used by each stage of the last run.",
+           [({"stage": name}, stage["attempts"]) for name, stage in data["stages"].items()])
+    metric("puig_rows_written", "gauge", "Rows written by each sink in the last run.",
+           [({"sink": write["sink"], "table": write["table"]}, write["rows"]) for write in data["writes"]])
+    metric("puig_write_duration_seconds", "gauge", "Seconds spent by each sink in the last run.",
+           [({"sink": write["sink"], "table": write["table"]}, write["seconds"]) for write in data["writes"]])
+    metric("puig_run_duration_seconds", "gauge", "Duration of the last run.", [({}, data["duration"])])
+    metric("puig_run_started_timestamp_seconds", "gauge", "Start time of the last run.", [({}, data["started"])])
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomic(path, content):
+    """write a file so readers never see it half written"""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def write_report(directory=None, suffix=""):
+    """write the JSON run report and the Prometheus textfile
+
+    The report is written as run-<timestamp>.json and copied to latest.json, so two runs
+    can be compared. puig_etl.prom is meant for the node_exporter textfile collector.
+
+    Args:
+        directory (string): optional argument. Defaults to METRICS_DIR
+        suffix (string): optional argument. Appended to the file names, keeps the reports of
+            processes running side by side (e.g. shards) apart
+
+    Returns:
+        string: path of the JSON report
+    """
+    directory = directory or METRICS_DIR
+    os.makedirs(directory, exist_ok=True)
+    data = report()
+    content = json.dumps(data, indent=2, default=str)
+    path = os.path.join(directory, time.strftime("run-%Y%m%d-%H%M%S", time.localtime(data["started"])) + f"{suffix}.json")
+    _write_atomic(path, content)
+    _write_atomic(os.path.join(directory, f"latest{suffix}.json"), content)
+    _write_atomic(os.path.join(directory, f"puig_etl{suffix}.prom"), prometheus_text(data))
+    print(f"Metrics written to {path}")
+    return path
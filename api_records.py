@@ -0,0 +1,76 @@
+import pandas as pd
+
+from api_schema import typed_series
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# RECORD ACCUMULATOR
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+class RecordAccumulator:
+    """Collect decoded API records into column buffers and build the DataFrame once.
+
+    Rows are appended either as tuples in column order or as dicts. Without a fixed
+    list of columns, columns are discovered from dict keys in first-seen order and
+    missing values are filled with None.
+
+    Args:
+        columns (list): optional argument. Column names, in the order tuple rows use
+    """
+
+    def __init__(self, columns=None):
+        self.columns = list(columns) if columns is not None else []
+        self._buffers = {column: [] for column in self.columns}
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, row):
+        """append one record
+
+        Args:
+            row (tuple or dict): record to append
+        """
+        if isinstance(row, dict):
+            for column in row:
+                if column not in self._buffers:
+                    self.columns.append(column)
+                    self._buffers[column] = [None] * self._length
+            for column in self.columns:
+                self._buffers[column].append(row.get(column))
+        else:
+            for column, value in zip(self.columns, row):
+                self._buffers[column].append(value)
+        self._length += 1
+
+    def extend(self, rows):
+        """append several records
+
+        Args:
+            rows (list): records to append
+        """
+        for row in rows:
+            self.append(row)
+
+    def to_frame(self, schema=None):
+        """build the DataFrame from the column buffers
+
+        Args:
+            schema (dict): optional argument. Declared dtype by column (see api_schema.SCHEMAS),
+                each buffer is converted straight to that dtype instead of an object column
+
+        Returns:
+            dataframe: one row per appended record
+        """
+        if not schema:
+            return pd.DataFrame(self._buffers, columns=self.columns)
+        return pd.DataFrame(
+            {
+                column: typed_series(self._buffers[column], schema[column], column)
+                if column in schema
+                else pd.Series(self._buffers[column], name=column)
+                for column in self.columns
+            },
+            columns=self.columns,
+        )
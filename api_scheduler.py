@@ -0,0 +1,141 @@
+import concurrent.futures
+import threading
+import time
+
+import api_metrics
+
+# Seconds to wait before the first retry of a failed stage, doubled on each attempt
+RETRY_DELAY = 30
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# STAGE SCHEDULER
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+class Stage:
+    """A unit of work in the run, started once every stage it depends on has finished.
+
+    Args:
+        name (string): stage name, referenced by the inputs of other stages
+        func (function): called with one keyword argument per input, holding that stage's result
+        inputs (list): optional argument. Names of the stages this one depends on
+        retries (int): optional argument. Number of extra attempts if the stage raises
+        timeout (float): optional argument. Seconds after which the stage is reported as failed
+    """
+
+    def __init__(self, name, func, inputs=(), retries=0, timeout=None):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.retries = retries
+        self.timeout = timeout
+        self.status = "pending"
+        self.attempts = 0
+        self.started = None
+        self.finished = None
+
+    @property
+    def duration(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.time()) - self.started
+
+
+def _start(stage, kwargs):
+    """run a stage with retries in a daemon thread
+
+    A thread that overruns its timeout can not be killed, so it is run as a daemon and
+    simply abandoned; nothing depending on it is started.
+
+    Returns:
+        concurrent.futures.Future: resolves to the stage result
+    """
+    future = concurrent.futures.Future()
+
+    def target():
+        for attempt in range(stage.retries + 1):
+            stage.attempts = attempt + 1
+            try:
+                future.set_result(stage.func(**kwargs))
+                return
+            except Exception as e:
+                if attempt == stage.retries:
+                    future.set_exception(e)
+                    return
+                delay = RETRY_DELAY * 2 ** attempt
+                print(f"Stage {stage.name} failed: {e}\nRetrying in {delay}s ({attempt + 1}/{stage.retries})")
+                time.sleep(delay)
+
+    stage.started = time.time()
+    stage.status = "running"
+    threading.Thread(target=target, name=f"stage-{stage.name}", daemon=True).start()
+    return future
+
+
+def print_summary(stages):
+    """print the status, attempts and duration of every stage"""
+    print(f"{'stage':<20}{'status':<12}{'attempts':>9}{'minutes':>10}")
+    for stage in stages:
+        print(f"{stage.name:<20}{stage.status:<12}{stage.attempts:>9}{stage.duration / 60:>10.2f}")
+
+
+def run_stages(stages):
+    """run stages concurrently, each as soon as all of its inputs are ready
+
+    Independent stages run in parallel. Stages whose inputs failed are skipped.
+    A timing summary is printed once every stage has finished.
+
+    Args:
+        stages (list): Stage objects
+
+    Returns:
+        dict: result of every successful stage, by stage name
+
+    Raises:
+        RuntimeError: if any stage failed, timed out or was skipped
+    """
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        for name in stage.inputs:
+            if name not in by_name:
+                raise ValueError(f"Stage {stage.name} depends on unknown stage {name}")
+    results = {}
+    running = {}
+    errors = {}
+    while True:
+        # start every pending stage whose inputs are all done
+        for stage in stages:
+            if stage.status != "pending":
+                continue
+            inputs = [by_name[name] for name in stage.inputs]
+            if any(dependency.status in ("failed", "timeout", "skipped") for dependency in inputs):
+                stage.status = "skipped"
+            elif all(dependency.status == "done" for dependency in inputs):
+                running[_start(stage, {name: results[name] for name in stage.inputs})] = stage
+        if not running:
+            break
+        deadlines = [stage.started + stage.timeout for stage in running.values() if stage.timeout]
+        wait = max(0, min(deadlines) - time.time()) if deadlines else None
+        done, _ = concurrent.futures.wait(running, timeout=wait, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            stage = running.pop(future)
+            stage.finished = time.time()
+            try:
+                results[stage.name] = future.result()
+                stage.status = "done"
+            except Exception as e:
+                stage.status = "failed"
+                errors[stage.name] = e
+        for future, stage in list(running.items()):
+            if stage.timeout and time.time() - stage.started >= stage.timeout:
+                running.pop(future)
+                stage.finished = time.time()
+                stage.status = "timeout"
+                errors[stage.name] = TimeoutError(f"Stage {stage.name} exceeded {stage.timeout}s")
+    for stage in stages:
+        api_metrics.record_stage(stage.name, stage.status, stage.duration, stage.attempts)
+    print_summary(stages)
+    unfinished = [stage.name for stage in stages if stage.status != "done"]
+    if unfinished:
+        raise RuntimeError(f"Stages did not complete: {', '.join(unfinished)}. Errors: {errors}")
+    return results
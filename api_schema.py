@@ -0,0 +1,113 @@
+import pandas as pd
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.types import BigInteger, Boolean, Float, Text
+
+# Declared dtype of the columns of each output table. Columns left out stay as decoded.
+#   "Int64", "Float64", "boolean": nullable numbers and flags, unparsable values become NA
+#   "string": text, "category": low cardinality text, "json": dicts and lists kept as objects
+SCHEMAS = {
+    "product_details": {
+        "id": "string",
+        "title": "string",
+        "description": "string",
+        "homologation": "string",
+        "references": "string",
+        "bikes": "string",
+        "technical": "json",
+        "multimedia": "json",
+    },
+    "variants": {
+        "sku": "string",
+        "reference": "string",
+        "product": "string",
+        "variations": "category",
+        "title": "string",
+        "description": "string",
+        "bikes": "string",
+        "aerotest": "string",
+        "comparative": "string",
+        "instructions": "string",
+    },
+    "variant_details": {
+        "sku": "string",
+        "reference": "string",
+        "colour": "category",
+        "stock": "Int64",
+        "stock_prevision": "string",
+        "outdated": "boolean",
+        "weight": "Float64",
+        "height": "Float64",
+        "width": "Float64",
+        "depth": "Float64",
+        "barcode": "string",
+        "alternative": "string",
+        "pvp": "Float64",
+        "pvp_recomended": "Float64",
+        "multimedia": "json",
+        "origin": "category",
+        "hs_code": "string",
+        "cost": "Float64",
+        "rrp": "Float64",
+    },
+    # link tables, one row per fitment or membership
+    "product_reference": {"product": "string", "reference": "string"},
+    "product_bike": {"product": "string", "bike": "string"},
+    "reference_bike": {"reference": "string", "bike": "string"},
+}
+# Postgres column type of each declared dtype
+SQL_TYPES = {
+    "Int64": BigInteger,
+    "Float64": Float(precision=53),
+    "boolean": Boolean,
+    "string": Text,
+    "category": Text,
+    "json": JSONB,
+}
+_BOOLEANS = {True: True, False: False, "1": True, "0": False, "true": True, "false": False, "True": True, "False": False}
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# TYPED COLUMNS
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def typed_series(values, dtype, name=None):
+    """build one column with its declared dtype
+
+    Args:
+        values (list or series): decoded values, None for missing ones
+        dtype (string): declared dtype, one of the keys of SQL_TYPES
+        name (string): optional argument. Column name
+
+    Returns:
+        series: column of the declared dtype
+    """
+    series = pd.Series(values, dtype=object, name=name)
+    if dtype in ("Int64", "Float64"):
+        return pd.to_numeric(series, errors="coerce").astype(dtype)
+    if dtype == "boolean":
+        return series.map(_BOOLEANS).astype("boolean")
+    if dtype == "string":
+        return series.astype("string")
+    if dtype == "category":
+        return series.astype("string").astype("category")
+    return series
+
+
+def sql_types(table, df=None):
+    """to_sql dtype argument mapping the declared columns of a table to Postgres types
+
+    Args:
+        table (string): table name in SCHEMAS
+        df (dataframe): optional argument. Only the columns of this frame are returned
+
+    Returns:
+        dict: sqlalchemy type by column name, None if the table has no schema
+    """
+    schema = SCHEMAS.get(table)
+    if schema is None:
+        return None
+    return {
+        column: SQL_TYPES[dtype]
+        for column, dtype in schema.items()
+        if df is None or column in df.columns
+    }
@@ -0,0 +1,83 @@
+"""Compare per-row DataFrames + pd.concat against the columnar RecordAccumulator.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_records --rows 50000
+"""
+import argparse
+import time
+
+import pandas as pd
+
+from api_functions import VARIANT_DETAILS_COLUMNS, variantdetails_process_endpoint
+from api_records import RecordAccumulator
+
+
+def make_bodies(rows):
+    """synthetic /references/{code}/{colour} responses"""
+    return [
+        {
+            "data": {
+                "code": f"{i:05d}",
+                "colour": "N",
+                "stock": i % 40,
+                "stock_prevision": None,
+                "outdated": False,
+                "weight": 0.35,
+                "height": 10,
+                "width": 20,
+                "depth": 5,
+                "barcode": f"8431{i:09d}",
+                "alternative": None,
+                "pvp": 49.95,
+                "pvp_recomended": 59.95,
+                "multimedia": {"images": [f"https://example.com/{i}.jpg"], "videos": []},
+                "origin": "ES",
+                "hs_code": "87141090",
+            }
+        }
+        for i in range(rows)
+    ]
+
+
+def legacy_process_endpoint(body):
+    """the previous decoder: one DataFrame per response filled with df.at"""
+    df = pd.DataFrame(columns=VARIANT_DETAILS_COLUMNS)
+    for column, value in zip(VARIANT_DETAILS_COLUMNS, variantdetails_process_endpoint(None, body)[0]):
+        df.at[0, column] = value
+    return df
+
+
+def run_legacy(bodies):
+    result = pd.DataFrame()
+    for body in bodies:
+        result = pd.concat([result, legacy_process_endpoint(body)], axis=0)
+    return result
+
+
+def run_accumulator(bodies):
+    records = RecordAccumulator(VARIANT_DETAILS_COLUMNS)
+    for body in bodies:
+        records.extend(variantdetails_process_endpoint(None, body))
+    return records.to_frame()
+
+
+def timed(func, bodies):
+    t0 = time.perf_counter()
+    df = func(bodies)
+    return df, time.perf_counter() - t0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--skip-legacy", action="store_true", help="only time the accumulator")
+    args = parser.parse_args()
+
+    bodies = make_bodies(args.rows)
+    df, elapsed = timed(run_accumulator, bodies)
+    print(f"accumulator: {len(df)} rows in {elapsed:.2f}s ({len(df) / elapsed:.0f} rows/sec)")
+    if not args.skip_legacy:
+        legacy_df, legacy_elapsed = timed(run_legacy, bodies)
+        print(f"legacy:      {len(legacy_df)} rows in {legacy_elapsed:.2f}s ({len(legacy_df) / legacy_elapsed:.0f} rows/sec)")
+        print(f"speedup:     {legacy_elapsed / elapsed:.1f}x")
@@ -0,0 +1,272 @@
+"""Local stand-in for api.puig.tv serving a synthetic catalogue.
+
+Run from the repository root, then point the pipeline at it with PUIG_API_URL:
+
+    python -m benchmarks.mock_api --products 500 --latency-ms 40 --error-rate 0.01
+    PUIG_API_URL=http://127.0.0.1:8080 python api_main.py
+
+The catalogue is generated from --seed, so two runs with the same arguments serve
+the same data. Every product has --references references, every reference has
+--colours colour variants.
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import threading
+
+from aiohttp import web
+
+COLOURS = "NCHWTRAGFBO"
+BRANDS = ["HONDA", "YAMAHA", "KAWASAKI", "SUZUKI", "BMW", "DUCATI", "KTM", "TRIUMPH"]
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# CATALOGUE
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+class Catalogue:
+    """Synthetic PUIG catalogue, every payload built up front.
+
+    Args:
+        products (int): number of products
+        references (int): optional argument. References per product
+        colours (int): optional argument. Colour variants per reference
+        bikes (int): optional argument. Number of bikes
+        categories (int): optional argument. Number of categories
+        seed (int): optional argument. Seed of the generator
+    """
+
+    def __init__(self, products, references=3, colours=3, bikes=200, categories=20, seed=0):
+        rng = random.Random(seed)
+        self.bikes = {}
+        self.categories = {}
+        self.products = {}
+        self.references = {}
+        self.variants = {}
+        bike_ids = [8000 + i for i in range(bikes)]
+        for bike_id in bike_ids:
+            self.bikes[bike_id] = {
+                "id": bike_id,
+                "brand": rng.choice(BRANDS),
+                "model": f"MODEL {rng.randint(100, 1300)}",
+                "year": rng.randint(2005, 2026),
+                "references": [],
+            }
+        for category_id in range(1, categories + 1):
+            self.categories[category_id] = [
+                {"id": category_id * 100 + i, "parent": category_id, "name": f"Subcategory {category_id}.{i}"}
+                for i in range(1, 4)
+            ]
+        for p in range(products):
+            product_id = 1100000 + p
+            codes = [f"{p * references + r:05d}" for r in range(references)]
+            product_bikes = rng.sample(bike_ids, min(len(bike_ids), rng.randint(1, 8)))
+            self.products[product_id] = {
+                "id": product_id,
+                "title": f"Product {product_id}",
+                "homologation": rng.choice([None, "E-mark", "TUV"]),
+                "references": codes,
+                "bikes": product_bikes,
+                "technical": {"material": rng.choice(["ABS", "Aluminium", "Polycarbonate"]), "weight": rng.randint(1, 50) / 10},
+                "multimedia": {"images": [f"https://cdn.example.com/{product_id}/{i}.jpg" for i in range(3)], "videos": []},
+                "category": rng.randint(1, categories),
+            }
+            for code in codes:
+                variations = list(COLOURS[:colours])
+                for bike_id in product_bikes:
+                    self.bikes[bike_id]["references"].append(code)
+                self.references[code] = {
+                    "code": code,
+                    "product": product_id,
+                    "variations": variations,
+                    "groups": [{"title": f"Reference {code}", "description": "Synthetic reference\nfor benchmarks"}],
+                    "bikes": product_bikes,
+                    "aerotest": None,
+                    "comparative": [f"https://cdn.example.com/comparative/{code}.pdf"],
+                    "instructions": [f"https://cdn.example.com/instructions/{code}.pdf"],
+                }
+                for colour in variations:
+                    pvp = round(rng.uniform(10, 400), 2)
+                    self.variants[(code, colour)] = {
+                        "code": code,
+                        "colour": colour,
+                        "stock": rng.randint(0, 200),
+                        "stock_prevision": rng.choice([None, "2026-11-30"]),
+                        "outdated": rng.random() < 0.05,
+                        "weight": rng.randint(50, 5000) / 1000,
+                        "height": rng.randint(5, 80),
+                        "width": rng.randint(5, 80),
+                        "depth": rng.randint(1, 30),
+                        "barcode": f"8431{rng.randint(0, 10 ** 9 - 1):09d}",
+                        "alternative": None,
+                        "pvp": pvp,
+                        "pvp_recomended": round(pvp * 1.21, 2),
+                        "multimedia": {"images": [f"https://cdn.example.com/{code}{colour}.jpg"], "onbike": []},
+                        "origin": rng.choice(["ES", "CN", "IT"]),
+                        "hs_code": "87141090",
+                    }
+        self.stock_version = 0
+
+    def bump_stock(self, fraction=0.1, seed=None):
+        """change the stock of a fraction of the variants, to exercise the hot mode and the cache"""
+        rng = random.Random(seed)
+        keys = list(self.variants)
+        for key in rng.sample(keys, int(len(keys) * fraction)):
+            self.variants[key]["stock"] = rng.randint(0, 200)
+        self.stock_version += 1
+
+    def __repr__(self):
+        return (f"Catalogue({len(self.products)} products, {len(self.references)} references, "
+                f"{len(self.variants)} variants, {len(self.bikes)} bikes)")
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# SERVER
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+class MockApi:
+    """aiohttp application serving a Catalogue with the routes of the PUIG API.
+
+    Args:
+        catalogue (Catalogue): data to serve
+        latency_ms (float): optional argument. Median latency added to every response
+        jitter (float): optional argument. Sigma of the lognormal latency distribution, 0 for a fixed latency
+        error_rate (float): optional argument. Share of requests answered with 503
+        seed (int): optional argument. Seed of the latency and error generator
+    """
+
+    def __init__(self, catalogue, latency_ms=0, jitter=0.5, error_rate=0.0, seed=0):
+        self.catalogue = catalogue
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.token = "bench-token"
+        # requests served by route, to compare the calls of two implementations
+        self.requests = {}
+        self.app = web.Application()
+        self.app.add_routes([
+            web.post("/{lang}/login", self.login),
+            web.get("/{lang}/bikes", self.bikes),
+            web.get("/{lang}/bikes/{id}", self.bike),
+            web.get("/{lang}/categories", self.categories),
+            web.get("/{lang}/categories/{id}", self.category),
+            web.get("/{lang}/products", self.products),
+            web.get("/{lang}/products/{id}", self.product),
+            web.get("/{lang}/references", self.references),
+            web.get("/{lang}/references/{code}", self.reference),
+            web.get("/{lang}/references/{code}/{colour}", self.variant),
+        ])
+        self._runner = None
+        self._loop = None
+
+    async def _respond(self, request, route, data):
+        self.requests[route] = self.requests.get(route, 0) + 1
+        if self.latency_ms:
+            latency = self.latency_ms * (self.rng.lognormvariate(0, self.jitter) if self.jitter else 1)
+            await asyncio.sleep(latency / 1000)
+        if route != "login" and request.headers.get("Api-Token") != self.token:
+            return web.json_response({"error": "invalid token"}, status=401)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            return web.json_response({"error": "unavailable"}, status=503)
+        if data is None:
+            return web.json_response({"error": "not found"}, status=404)
+        body = json.dumps({"data": data}).encode()
+        etag = '"' + hashlib.md5(body).hexdigest() + '"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+    async def login(self, request):
+        return await self._respond(request, "login", {"token": self.token})
+
+    async def bikes(self, request):
+        data = [{key: bike[key] for key in ("id", "brand", "model", "year")} for bike in self.catalogue.bikes.values()]
+        return await self._respond(request, "bikes", data)
+
+    async def bike(self, request):
+        return await self._respond(request, "bikes/{id}", self.catalogue.bikes.get(int(request.match_info["id"])))
+
+    async def categories(self, request):
+        data = [{"id": category_id, "name": f"Category {category_id}"} for category_id in self.catalogue.categories]
+        return await self._respond(request, "categories", data)
+
+    async def category(self, request):
+        return await self._respond(request, "categories/{id}", self.catalogue.categories.get(int(request.match_info["id"])))
+
+    async def products(self, request):
+        data = [{"id": product["id"], "title": product["title"], "category": product["category"]}
+                for product in self.catalogue.products.values()]
+        return await self._respond(request, "products", data)
+
+    async def product(self, request):
+        return await self._respond(request, "products/{id}", self.catalogue.products.get(int(request.match_info["id"])))
+
+    async def references(self, request):
+        return await self._respond(request, "references", list(self.catalogue.references))
+
+    async def reference(self, request):
+        return await self._respond(request, "references/{code}", self.catalogue.references.get(request.match_info["code"]))
+
+    async def variant(self, request):
+        key = (request.match_info["code"], request.match_info["colour"])
+        return await self._respond(request, "references/{code}/{colour}", self.catalogue.variants.get(key))
+
+    def start(self, host="127.0.0.1", port=0):
+        """serve in a background thread
+
+        Args:
+            host (string): optional argument. Interface to listen on
+            port (int): optional argument. 0 picks a free port
+
+        Returns:
+            string: base url of the server, to use as PUIG_API_URL
+        """
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_forever, name="mock-api", daemon=True).start()
+
+        async def serve():
+            self._runner = web.AppRunner(self.app, access_log=None)
+            await self._runner.setup()
+            site = web.TCPSite(self._runner, host, port)
+            await site.start()
+            return site._server.sockets[0].getsockname()[1]
+
+        port = asyncio.run_coroutine_threadsafe(serve(), self._loop).result()
+        return f"http://{host}:{port}"
+
+    def stop(self):
+        """shut the server down"""
+        asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def add_arguments(parser):
+    """catalogue and server options shared with bench_pipeline"""
+    parser.add_argument("--products", type=int, default=200, help="number of products in the catalogue")
+    parser.add_argument("--references", type=int, default=3, help="references per product")
+    parser.add_argument("--colours", type=int, default=3, help="colour variants per reference")
+    parser.add_argument("--bikes", type=int, default=200, help="number of bikes")
+    parser.add_argument("--latency-ms", type=float, default=20, help="median latency of a response")
+    parser.add_argument("--jitter", type=float, default=0.5, help="sigma of the lognormal latency, 0 for fixed latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 503")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def from_arguments(args):
+    """build the MockApi described by the add_arguments() options"""
+    catalogue = Catalogue(args.products, args.references, args.colours, args.bikes, seed=args.seed)
+    return MockApi(catalogue, args.latency_ms, args.jitter, args.error_rate, seed=args.seed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    args = parser.parse_args()
+    mock = from_arguments(args)
+    print(f"Serving {mock.catalogue} on http://{args.host}:{args.port}")
+    web.run_app(mock.app, host=args.host, port=args.port, access_log=None)
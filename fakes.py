@@ -0,0 +1,188 @@
+"""In-memory stand-ins for the Google clients, for running sinks without network access.
+
+    import api_data_read_write
+    from fakes import FakeClient
+    api_data_read_write.sa = FakeClient()
+    api_data_read_write.sheets = api_data_read_write.SheetsSession(api_data_read_write.sa)
+    drive = FakeDrive(files)
+    api_data_read_write.drive_service_factory = lambda: drive
+"""
+import re
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# GOOGLE SHEETS
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+def _a1_to_index(cell):
+    """zero based (row, col) of an A1 cell"""
+    letters, digits = re.match(r"^([A-Z]+)(\d+)$", cell.upper()).groups()
+    col = 0
+    for letter in letters:
+        col = col * 26 + ord(letter) - ord("A") + 1
+    return int(digits) - 1, col - 1
+
+
+class FakeWorksheet:
+    """Worksheet keeping its cells in a list of lists, with the gspread calls the sinks use.
+
+    Args:
+        title (string): worksheet name
+        values (list): optional argument. Initial rows of cell values
+        rows (int): optional argument. Number of rows of the grid
+        cols (int): optional argument. Number of columns of the grid
+    """
+
+    def __init__(self, title, values=None, rows=1000, cols=26):
+        self.title = title
+        self.row_count = max(rows, len(values or []))
+        self.col_count = max([cols] + [len(row) for row in values or []])
+        self.cells = [["" for _ in range(self.col_count)] for _ in range(self.row_count)]
+        for r, row in enumerate(values or []):
+            for c, value in enumerate(row):
+                self.cells[r][c] = value
+        # number of calls per method, to check how much API quota a sink would use
+        self.calls = {}
+
+    def _count(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    def _write(self, range_name, values):
+        start = range_name.split("!")[-1].split(":")[0]
+        row0, col0 = _a1_to_index(start)
+        if row0 + len(values) > self.row_count or col0 + max([0] + [len(row) for row in values]) > self.col_count:
+            raise ValueError(f"Range {range_name} exceeds grid limits of {self.title}")
+        for r, row in enumerate(values):
+            for c, value in enumerate(row):
+                self.cells[row0 + r][col0 + c] = "" if value is None else str(value)
+
+    def get_all_values(self):
+        self._count("get_all_values")
+        rows = [list(row) for row in self.cells]
+        while rows and not any(rows[-1]):
+            rows.pop()
+        width = max([0] + [max([i + 1 for i, value in enumerate(row) if value != ""] or [0]) for row in rows])
+        return [row[:width] for row in rows]
+
+    def get_all_records(self):
+        values = self.get_all_values()
+        if not values:
+            return []
+        return [dict(zip(values[0], row)) for row in values[1:]]
+
+    def update(self, range_name, values=None, raw=True):
+        """supports update(values) as well as update(range_name, values)"""
+        self._count("update")
+        if values is None:
+            range_name, values = "A1", range_name
+        if not isinstance(values, list):
+            values = [[values]]
+        self._write(range_name, values)
+
+    def batch_update(self, data, raw=True):
+        self._count("batch_update")
+        for update in data:
+            self._write(update["range"], update["values"])
+
+    def clear(self):
+        self._count("clear")
+        self.cells = [["" for _ in range(self.col_count)] for _ in range(self.row_count)]
+
+    def add_rows(self, rows):
+        self._count("add_rows")
+        self.cells += [["" for _ in range(self.col_count)] for _ in range(rows)]
+        self.row_count += rows
+
+    def add_cols(self, cols):
+        self._count("add_cols")
+        for row in self.cells:
+            row += ["" for _ in range(cols)]
+        self.col_count += cols
+
+
+class FakeSpreadsheet:
+    """Workbook holding FakeWorksheets by title, created on first access."""
+
+    def __init__(self, title):
+        self.title = title
+        self.worksheets = {}
+        self.calls = {}
+
+    def worksheet(self, title):
+        self.calls["worksheet"] = self.calls.get("worksheet", 0) + 1
+        if title not in self.worksheets:
+            self.worksheets[title] = FakeWorksheet(title)
+        return self.worksheets[title]
+
+    def values_batch_update(self, body):
+        self.calls["values_batch_update"] = self.calls.get("values_batch_update", 0) + 1
+        for update in body["data"]:
+            title, range_name = update["range"].rsplit("!", 1)
+            title = title[1:-1].replace("''", "'") if title.startswith("'") else title
+            self.worksheets[title]._write(range_name, update["values"])
+
+
+class FakeClient:
+    """Stand-in for the gspread client returned by gspread.service_account()."""
+
+    def __init__(self):
+        self.spreadsheets = {}
+        self.calls = {}
+
+    def open(self, title):
+        self.calls["open"] = self.calls.get("open", 0) + 1
+        if title not in self.spreadsheets:
+            self.spreadsheets[title] = FakeSpreadsheet(title)
+        return self.spreadsheets[title]
+# -------------------------------------------------------------------------------------------------------------------------------
+
+# GOOGLE DRIVE
+# -------------------------------------------------------------------------------------------------------------------------------
+
+
+class _FakeRequest:
+    def __init__(self, response):
+        self._response = response
+
+    def execute(self):
+        return self._response
+
+
+class FakeDrive:
+    """Stand-in for the Drive v3 client, answering files().list() from a list of file dicts.
+
+    Understands the query terms read_gdrive uses: parents in, mimeType=,
+    modifiedTime > and trashed = false.
+
+    Args:
+        files (list): optional argument. Dicts with id, name, mimeType, parents, modifiedTime and trashed
+    """
+
+    def __init__(self, files=None):
+        self.files_list = list(files or [])
+        self.calls = {}
+
+    def files(self):
+        return self
+
+    def list(self, q="", fields=None, pageToken=None, pageSize=100):
+        self.calls["list"] = self.calls.get("list", 0) + 1
+        terms = {
+            "parent": re.search(r"parents in '([^']*)'", q),
+            "mime": re.search(r"mimeType\s*=\s*'([^']*)'", q),
+            "since": re.search(r"modifiedTime\s*>\s*'([^']*)'", q),
+        }
+        live_only = re.search(r"trashed\s*=\s*false", q) is not None
+        matches = [
+            item for item in self.files_list
+            if (terms["parent"] is None or terms["parent"].group(1) in item.get("parents", []))
+            and (terms["mime"] is None or item.get("mimeType") == terms["mime"].group(1))
+            and (terms["since"] is None or item.get("modifiedTime", "") > terms["since"].group(1))
+            and not (live_only and item.get("trashed"))
+        ]
+        start = int(pageToken or 0)
+        page = matches[start:start + pageSize]
+        response = {"files": [dict(item) for item in page]}
+        if start + pageSize < len(matches):
+            response["nextPageToken"] = str(start + pageSize)
+        return _FakeRequest(response)
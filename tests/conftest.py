@@ -0,0 +1,7 @@
+import os
+import sys
+import tempfile
+
+# modules read their configuration at import time, keep local state out of the checkout
+os.environ.setdefault("PUIG_CACHE_DIR", tempfile.mkdtemp(prefix="puig-tests-"))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,108 @@
+import gzip
+import os
+
+import pytest
+
+import api_archive
+import api_fetch
+import api_functions
+from api_archive import Archive, Replay, prune, runs
+
+URL = "https://api.puig.tv/en/references/3755"
+
+
+@pytest.fixture(autouse=True)
+def keep(monkeypatch):
+    monkeypatch.setattr(api_archive, "ARCHIVE_KEEP", 2)
+
+
+def fake_run(directory, kind, run_id, complete=True):
+    path = directory / kind / run_id
+    path.mkdir(parents=True)
+    with gzip.open(path / "references_code.jsonl.gz", "wt", encoding="utf-8") as f:
+        f.write('{"url": "%s", "body": {"data": "%s"}}\n' % (URL, run_id))
+    if complete:
+        (path / api_archive.COMPLETE_MARKER).touch()
+    return run_id
+
+
+def test_replay_serves_the_archived_body(tmp_path):
+    archive = Archive("full", directory=str(tmp_path))
+    archive.write(URL, b'{"data":\n {"code": "3755"}}')
+    archive.close()
+    replay = Replay(directory=str(tmp_path))
+    assert replay.lookup(URL) == {"data": {"code": "3755"}}
+    assert replay.lookup(URL + "/N") is None
+    assert replay.stats == {"served": 1, "missing": 1}
+
+
+def test_runs_in_progress_are_never_pruned(tmp_path):
+    # the pid of this process, so the run counts as still being written
+    in_progress = fake_run(tmp_path, "full", f"20000101-000000-{os.getpid()}", complete=False)
+    for second in range(4):
+        fake_run(tmp_path, "full", f"20240101-00000{second}-1")
+    prune("full", str(tmp_path))
+    assert runs("full", str(tmp_path)) == ["20240101-000002-1", "20240101-000003-1"]
+    assert in_progress in runs("full", str(tmp_path), complete=False)
+
+
+def test_failed_runs_are_pruned_once_their_process_is_gone(tmp_path):
+    # no process has such a pid
+    for second in range(4):
+        fake_run(tmp_path, "full", f"20240101-00000{second}-999999999", complete=False)
+    prune("full", str(tmp_path))
+    assert runs("full", str(tmp_path), complete=False) == ["20240101-000002-999999999", "20240101-000003-999999999"]
+
+
+def test_hot_runs_do_not_prune_full_runs(tmp_path):
+    full = fake_run(tmp_path, "full", "20240101-000000-1")
+    for minute in range(5):
+        fake_run(tmp_path, "hot", f"20240101-01{minute}000-1")
+    Archive("hot", directory=str(tmp_path)).close()
+    assert runs("full", str(tmp_path)) == [full]
+    assert len(runs("hot", str(tmp_path))) == 2
+
+
+def test_latest_is_the_newest_complete_run_of_its_kind(tmp_path):
+    fake_run(tmp_path, "full", "20240101-000000-1")
+    fake_run(tmp_path, "full", "20240102-000000-1", complete=False)
+    fake_run(tmp_path, "hot", "20240103-000000-1")
+    assert Replay(directory=str(tmp_path)).lookup(URL) == {"data": "20240101-000000-1"}
+    assert Replay(kind="hot", directory=str(tmp_path)).lookup(URL) == {"data": "20240103-000000-1"}
+    # an interrupted run can still be replayed by its id
+    assert Replay("20240102-000000-1", directory=str(tmp_path)).lookup(URL) == {"data": "20240102-000000-1"}
+    with pytest.raises(FileNotFoundError):
+        Replay(kind="shard-0-of-4", directory=str(tmp_path))
+
+
+def test_failed_run_is_not_offered_as_latest(tmp_path):
+    archive = Archive("full", directory=str(tmp_path))
+    archive.write(URL, b'{"data": 1}')
+    archive.close(complete=False)
+    with pytest.raises(FileNotFoundError):
+        Replay(directory=str(tmp_path))
+
+
+def test_truncated_archive_keeps_the_lines_read(tmp_path):
+    fake_run(tmp_path, "full", "20240101-000000-1")
+    path = tmp_path / "full" / "20240101-000000-1" / "references_code_colour.jsonl.gz"
+    data = gzip.compress(b'{"url": "%s/N", "body": {"data": 2}}\n' % URL.encode() * 50)
+    path.write_bytes(data[:-20])
+    replay = Replay(directory=str(tmp_path))
+    assert replay.lookup(URL) == {"data": "20240101-000000-1"}
+
+
+def test_replay_misses_are_dead_letters_not_final(tmp_path, monkeypatch):
+    archive = Archive("full", directory=str(tmp_path))
+    archive.write(URL, b'{"data": {"code": "3755"}}')
+    archive.close()
+    monkeypatch.setattr(api_fetch, "replay", Replay(directory=str(tmp_path)))
+    monkeypatch.setattr(api_fetch, "dead_letters", [])
+    monkeypatch.setattr(api_functions, "dead_letters", api_fetch.dead_letters)
+    mark = api_functions.failure_mark()
+    missing = URL.replace("3755", "3756")
+    results = list(api_fetch.fetch_pipeline([URL, missing], lambda endpoint, body: body["data"]))
+    assert [endpoint for decoder, endpoint, result in results] == [URL]
+    assert api_fetch.dead_letters == [missing]
+    # the stage is not complete, so delete_missing stays off
+    assert not api_functions.fetched_all(mark, ["references/{code}"])
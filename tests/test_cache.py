@@ -0,0 +1,32 @@
+import pytest
+
+import api_metrics
+from api_cache import ResponseCache, endpoint_family
+
+
+@pytest.mark.parametrize("url, family", [
+    ("https://api.puig.tv/en/bikes", "bikes"),
+    ("https://api.puig.tv/en/bikes/12", "bikes/{id}"),
+    ("https://api.puig.tv/en/products/1100775", "products/{id}"),
+    ("https://api.puig.tv/es/references", "references"),
+    ("https://api.puig.tv/en/references/3755", "references/{code}"),
+    ("https://api.puig.tv/en/references/3755/N", "references/{code}/{colour}"),
+    ("https://api.puig.tv/en/references/3755/N?stock=1", "references/{code}/{colour}"),
+    ("http://127.0.0.1:8080/en/categories/4", "categories/{id}"),
+    ("https://api.puig.tv/login", "https://api.puig.tv/login"),
+])
+def test_endpoint_family(url, family):
+    assert endpoint_family(url) == family
+
+
+def test_a_200_with_the_cached_content_is_unchanged_not_a_miss(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_metrics, "_requests", {})
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    url = "https://api.puig.tv/en/references/3755"
+    for body in (b'{"data": 1}', b'{"data": 1}', b'{"data": 2}'):
+        changed = cache.store(url, body, etag='"v1"')
+        api_metrics.record_cache(endpoint_family(url), "miss" if changed else "unchanged")
+    assert cache.stats == {"hit": 0, "revalidated": 0, "unchanged": 1, "miss": 2}
+    text = api_metrics.prometheus_text()
+    assert 'puig_api_cache_total{family="references/{code}",result="unchanged"} 1' in text
+    assert 'puig_api_cache_total{family="references/{code}",result="miss"} 2' in text
@@ -0,0 +1,69 @@
+import pytest
+
+import api_data_read_write
+from api_data_read_write import read_gdrive
+from fakes import FakeDrive
+
+FOLDER = "folder"
+JPEG = "image/jpeg"
+
+
+def image(file_id, name, modified, trashed=False, parent=FOLDER):
+    return {"id": file_id, "name": name, "mimeType": JPEG, "parents": [parent],
+            "modifiedTime": modified, "trashed": trashed}
+
+
+@pytest.fixture(autouse=True)
+def manifest_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_data_read_write, "MANIFEST_DIR", str(tmp_path))
+
+
+def test_full_listing_skips_trashed_files_and_other_folders():
+    drive = FakeDrive([
+        image("1", "3755N-front.jpg", "2024-01-01T00:00:00"),
+        image("2", "3756H-side.jpg", "2024-01-01T00:00:00", trashed=True),
+        image("3", "9999N-front.jpg", "2024-01-01T00:00:00", parent="other"),
+    ])
+    df = read_gdrive(FOLDER, JPEG, service=drive)
+    assert df["ID"].tolist() == ["1"]
+    assert df["SKU"].tolist() == ["3755N"]
+    assert df["URL"].tolist() == ["https://drive.google.com/uc?id=1"]
+
+
+def test_incremental_listing_only_asks_for_modified_files():
+    drive = FakeDrive([image("1", "3755N-front.jpg", "2000-01-01T00:00:00")])
+    read_gdrive(FOLDER, JPEG, service=drive)
+    # unchanged since the last sync, so not listed again but kept from the manifest
+    drive.files_list[0]["name"] = "renamed-without-a-new-modified-time.jpg"
+    df = read_gdrive(FOLDER, JPEG, service=drive)
+    assert df["Name"].tolist() == ["3755N-front.jpg"]
+
+
+def test_incremental_listing_applies_changes_and_trashed_files():
+    drive = FakeDrive([
+        image("1", "3755N-front.jpg", "2000-01-01T00:00:00"),
+        image("2", "3756H-side.jpg", "2000-01-01T00:00:00"),
+    ])
+    read_gdrive(FOLDER, JPEG, service=drive)
+    drive.files_list = [
+        image("1", "3755N-back.jpg", "2999-01-01T00:00:00"),
+        image("2", "3756H-side.jpg", "2999-01-01T00:00:00", trashed=True),
+        image("3", "3757W-top.jpg", "2999-01-01T00:00:00"),
+    ]
+    df = read_gdrive(FOLDER, JPEG, service=drive).sort_values("ID")
+    assert df["ID"].tolist() == ["1", "3"]
+    assert df["Name"].tolist() == ["3755N-back.jpg", "3757W-top.jpg"]
+
+
+def test_full_sync_drops_files_deleted_outright():
+    drive = FakeDrive([image("1", "3755N-front.jpg", "2000-01-01T00:00:00")])
+    read_gdrive(FOLDER, JPEG, service=drive)
+    drive.files_list = []
+    assert read_gdrive(FOLDER, JPEG, service=drive)["ID"].tolist() == ["1"]
+    assert read_gdrive(FOLDER, JPEG, full=True, service=drive).empty
+
+
+def test_pdf_sku_is_the_file_name():
+    drive = FakeDrive([{"id": "1", "name": "3755N.pdf", "mimeType": "application/pdf", "parents": [FOLDER],
+                        "modifiedTime": "2024-01-01T00:00:00"}])
+    assert read_gdrive(FOLDER, "application/pdf", service=drive)["SKU"].tolist() == ["3755N"]
@@ -0,0 +1,40 @@
+import concurrent.futures
+
+import pytest
+
+import api_fetch
+from api_fetch import fetch_pipeline
+
+
+@pytest.fixture
+def submitted(monkeypatch):
+    """answer every request at once with its url, recording the order of submission"""
+    urls = []
+
+    def submit(url, headers=None):
+        urls.append(url)
+        future = concurrent.futures.Future()
+        future.set_result((200, url))
+        return future
+
+    monkeypatch.setattr(api_fetch, "submit", submit)
+    monkeypatch.setattr(api_fetch, "SUBMIT_WINDOW", 3)
+    return urls
+
+
+def test_requests_are_submitted_as_results_are_consumed(submitted):
+    endpoints = [f"e{i}" for i in range(10)]
+    results = fetch_pipeline(endpoints, lambda endpoint, body: body)
+    assert next(results)[2] == "e0"
+    # the window, not every endpoint of the stage
+    assert submitted == ["e0", "e1", "e2"]
+    assert [result for decoder, endpoint, result in results] == endpoints[1:]
+    assert submitted == endpoints
+
+
+def test_follow_ups_go_before_the_remaining_endpoints(submitted):
+    endpoints = [f"e{i}" for i in range(4)]
+    follow = lambda endpoint, result: [(f"{endpoint}/d", lambda endpoint, body: body)]
+    results = [endpoint for decoder, endpoint, result in fetch_pipeline(endpoints, lambda e, b: b, follow=follow)]
+    assert sorted(results) == sorted(endpoints + [f"{e}/d" for e in endpoints])
+    assert submitted.index("e0/d") < submitted.index("e3")
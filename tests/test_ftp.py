@@ -0,0 +1,30 @@
+import pandas as pd
+
+import api_data_read_write
+from api_data_read_write import ftp_read
+
+URL = "https://picbox.example/stock.xlsx"
+STAT = {"last_modified": "Mon, 01 Jan 2024 00:00:00 GMT", "content_length": "6"}
+
+
+def test_without_pyarrow_the_workbook_is_parsed_but_not_downloaded_again(tmp_path, monkeypatch):
+    downloads = []
+
+    def download_file(url, filename):
+        downloads.append(url)
+        with open(filename, "wb") as f:
+            f.write(b"xlsx..")
+
+    def no_pyarrow(*args, **kwargs):
+        raise ImportError("Unable to find a usable engine; tried using: 'pyarrow', 'fastparquet'.")
+
+    monkeypatch.setattr(api_data_read_write, "download_file", download_file)
+    monkeypatch.setattr(api_data_read_write, "_remote_stat", lambda url: STAT)
+    monkeypatch.setattr(pd, "read_excel", lambda filename: pd.DataFrame({"SKU": ["3755N"], "Stock": [None]}))
+    monkeypatch.setattr(pd, "read_parquet", no_pyarrow)
+    monkeypatch.setattr(pd.DataFrame, "to_parquet", no_pyarrow)
+    filename = str(tmp_path / "stock.xlsx")
+    for run in range(2):
+        df = ftp_read(URL, filename)
+        assert df.to_dict("records") == [{"SKU": "3755N", "Stock": ""}]
+    assert downloads == [URL]
@@ -0,0 +1,54 @@
+import pytest
+
+import api_journal
+from api_journal import Journal
+
+
+@pytest.fixture(autouse=True)
+def journal_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_journal, "JOURNAL_DIR", str(tmp_path))
+    monkeypatch.setattr(api_journal, "_open", {})
+    return tmp_path
+
+
+def test_new_run_starts_empty():
+    journal = Journal("variants")
+    journal.append("a", [("1", 2)])
+    journal._file.close()
+    api_journal._open.clear()
+    assert Journal("variants").completed() == {}
+
+
+def test_resume_reloads_rows_as_tuples_and_dicts():
+    journal = Journal("variants")
+    journal.append("a", [("1", 2), {"x": 1}])
+    journal._file.close()
+    api_journal._open.clear()
+    assert Journal("variants", resume=True).completed() == {"a": [("1", 2), {"x": 1}]}
+
+
+def test_torn_last_line_is_skipped_and_appends_start_on_a_new_line(journal_dir):
+    path = journal_dir / "variants.jsonl"
+    path.write_text('{"endpoint": "a", "rows": [[1]]}\n{"endpoint": "b", "ro', encoding="utf-8")
+    journal = Journal("variants", resume=True)
+    assert journal.completed() == {"a": [(1,)]}
+    journal.append("c", [[3]])
+    journal._file.close()
+    api_journal._open.clear()
+    assert Journal("variants", resume=True).completed() == {"a": [(1,)], "c": [(3,)]}
+
+
+def test_retry_in_the_same_run_keeps_the_first_attempt():
+    first = Journal("variants")
+    first.append("a", [(1,)])
+    second = Journal("variants")
+    assert first._file.closed
+    assert second.completed() == {"a": [(1,)]}
+
+
+def test_clear_removes_the_journal(journal_dir):
+    journal = Journal("variants")
+    journal.append("a", [(1,)])
+    journal.clear()
+    assert not (journal_dir / "variants.jsonl").exists()
+    assert Journal("variants").completed() == {}
@@ -0,0 +1,67 @@
+import pytest
+from sqlalchemy import create_engine
+
+import api_data_read_write
+import api_functions
+from api_data_read_write import ChunkedWriter, db_has_table, db_read
+from api_functions import VARIANT_DETAILS_COLUMNS, merge_shards, shard_table, variant_details_chunk
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+    monkeypatch.setattr(api_data_read_write, "pool", create_engine(f"sqlite:///{tmp_path / 'test.db'}"))
+
+
+def detail(reference, colour):
+    return (reference, colour, 3, None, False, 1.0, 1.0, 1.0, 1.0, None, None, 10.0, 12.0, {}, None, None)
+
+
+def write_shard(index, count, rows):
+    writer = ChunkedWriter(shard_table("variant_details", index, count), VARIANT_DETAILS_COLUMNS, key="sku",
+                           mode="replace", transform=variant_details_chunk, schema="variant_details", chunk_rows=2)
+    writer.extend(rows)
+    writer.finish()
+
+
+def test_empty_shard_still_writes_its_table():
+    write_shard(0, 2, [])
+    assert db_has_table("variant_details__shard_0_of_2")
+    assert "sku" in db_read('select * from "variant_details__shard_0_of_2";').columns
+
+
+def test_merge_only_the_tables_the_shards_wrote():
+    write_shard(0, 2, [detail("1", "N"), detail("2", "N"), detail("3", "N")])
+    write_shard(1, 2, [])
+    merge_shards(2)
+    assert sorted(db_read("select sku from variant_details;")["sku"]) == ["1N", "2N", "3N"]
+    assert not db_has_table("variant_details__shard_0_of_2")
+    assert not db_has_table("variants")
+
+
+def test_merge_waits_for_every_shard():
+    write_shard(0, 2, [detail("1", "N")])
+    with pytest.raises(RuntimeError, match="variant_details__shard_1_of_2"):
+        merge_shards(2)
+    assert db_has_table("variant_details__shard_0_of_2")
+
+
+def test_merge_without_any_shard_table_fails():
+    with pytest.raises(RuntimeError, match="No shard tables"):
+        merge_shards(2)
+
+
+def test_merge_deletes_missing_rows_only_once_every_shard_is_complete(monkeypatch):
+    merges = []
+    monkeypatch.setattr(api_functions, "db_merge",
+                        lambda sources, table, key, delete_missing=False: merges.append(delete_missing))
+    monkeypatch.setattr(api_functions, "DELETE_MISSING", True)
+    for complete in (False, True):
+        for index in range(2):
+            monkeypatch.setattr(api_functions, "shard", (index, 2))
+            writer = ChunkedWriter(shard_table("variant_details"), VARIANT_DETAILS_COLUMNS, key="sku",
+                                   mode="replace", transform=variant_details_chunk, schema="variant_details")
+            # the first round, shard 1 had dead letters
+            api_functions.finish_writers([writer], complete or index == 0)
+        merge_shards(2)
+    assert merges == [False, True]
+    assert not db_has_table("variant_details__shard_0_of_2__complete")
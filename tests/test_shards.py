@@ -0,0 +1,36 @@
+import api_functions
+from api_functions import in_shard, shard_of, shard_table
+
+
+def test_shard_of_is_stable_and_in_range():
+    # md5 based, the same on every machine and python version
+    assert shard_of("3755", 4) == 1
+    assert shard_of("3755", 4) == shard_of(3755, 4)
+    assert all(0 <= shard_of(str(code), 7) < 7 for code in range(1000))
+    assert shard_of("anything", 1) == 0
+
+
+def test_shards_split_codes_evenly():
+    counts = [0] * 4
+    for code in range(4000):
+        counts[shard_of(str(code), 4)] += 1
+    assert min(counts) > 800
+
+
+def test_every_code_belongs_to_exactly_one_shard(monkeypatch):
+    codes = [str(code) for code in range(200)]
+    owners = {code: [] for code in codes}
+    for i in range(3):
+        monkeypatch.setattr(api_functions, "shard", (i, 3))
+        for code in codes:
+            if in_shard(code):
+                owners[code].append(i)
+    assert all(len(shards) == 1 for shards in owners.values())
+
+
+def test_shard_table(monkeypatch):
+    monkeypatch.setattr(api_functions, "shard", None)
+    assert shard_table("variants") == "variants"
+    assert shard_table("variants", 1, 4) == "variants__shard_1_of_4"
+    monkeypatch.setattr(api_functions, "shard", (2, 4))
+    assert shard_table("variants") == "variants__shard_2_of_4"
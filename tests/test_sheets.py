@@ -0,0 +1,94 @@
+import pandas as pd
+import pytest
+
+import api_data_read_write
+from api_data_read_write import SheetsSession, flush_sheets, sh_sync, sheet_diff
+from fakes import FakeClient
+
+
+@pytest.fixture
+def client(monkeypatch):
+    fake = FakeClient()
+    monkeypatch.setattr(api_data_read_write, "sheets", SheetsSession(fake))
+    return fake
+
+
+def test_unchanged_sheet_has_no_blocks():
+    df = pd.DataFrame({"id": [1, 2], "name": ["a", "b"]})
+    assert sheet_diff([["id", "name"], ["1", "a"], ["2", "b"]], df, key="id") == ([], 2)
+
+
+def test_rows_keep_their_position_when_keys_are_reordered():
+    df = pd.DataFrame({"id": [1, 2, 3], "name": ["a", "b", "c"]})
+    current = [["id", "name"], ["3", "c"], ["1", "a"], ["2", "b"]]
+    assert sheet_diff(current, df, key="id") == ([], 2)
+
+
+def test_changed_row_is_written_in_place():
+    df = pd.DataFrame({"id": [1, 2], "name": ["a", "B"]})
+    current = [["id", "name"], ["2", "b"], ["1", "a"]]
+    assert sheet_diff(current, df, key="id") == ([(2, [[2, "B"]])], 2)
+
+
+def test_removed_key_shifts_rows_up_and_blanks_the_last_one():
+    df = pd.DataFrame({"id": [1, 3], "name": ["a", "c"]})
+    current = [["id", "name"], ["1", "a"], ["2", "b"], ["3", "c"]]
+    blocks, width = sheet_diff(current, df, key="id")
+    assert blocks == [(3, [[3, "c"], ["", ""]])]
+
+
+def test_new_keys_are_appended():
+    df = pd.DataFrame({"id": [4, 1], "name": ["d", "a"]})
+    current = [["id", "name"], ["1", "a"]]
+    assert sheet_diff(current, df, key="id") == ([(3, [[4, "d"]])], 2)
+
+
+def test_duplicate_keys_are_matched_by_occurrence():
+    df = pd.DataFrame({"id": [1, 1, 2], "name": ["x", "y", "z"]})
+    current = [["id", "name"], ["2", "z"], ["1", "x"], ["1", "y"]]
+    assert sheet_diff(current, df, key="id") == ([], 2)
+    df = pd.DataFrame({"id": [1, 2], "name": ["x", "z"]})
+    assert sheet_diff(current, df, key="id") == ([(4, [["", ""]])], 2)
+
+
+def test_header_change_compares_by_position():
+    df = pd.DataFrame({"id": [2, 1], "title": ["b", "a"]})
+    current = [["id", "name"], ["1", "a"], ["2", "b"]]
+    blocks, width = sheet_diff(current, df, key="id")
+    assert blocks == [(1, [["id", "title"], [2, "b"], [1, "a"]])]
+
+
+def test_missing_and_formatted_values_compare_as_displayed():
+    df = pd.DataFrame({"id": [1], "price": [10.0], "flag": [True], "note": [None]})
+    current = [["id", "price", "flag", "note"], ["1", "10", "TRUE", ""]]
+    assert sheet_diff(current, df, key="id") == ([], 4)
+
+
+def test_sync_writes_changes_and_then_nothing(client):
+    df = pd.DataFrame({"id": [1, 2], "name": ["a", "b"]})
+    sh_sync(df, "PUIG", "products", key="id")
+    flush_sheets()
+    worksheet = client.open("PUIG").worksheet("products")
+    assert worksheet.get_all_values() == [["id", "name"], ["1", "a"], ["2", "b"]]
+
+    sh_sync(df.iloc[::-1], "PUIG", "products", key="id")
+    flush_sheets()
+    assert client.open("PUIG").calls["values_batch_update"] == 1
+
+
+def test_sync_leaves_no_trailing_rows_when_the_data_shrinks(client):
+    sh_sync(pd.DataFrame({"id": [1, 2, 3], "name": ["a", "b", "c"]}), "PUIG", "products", key="id")
+    sh_sync(pd.DataFrame({"id": [3], "name": ["c"]}), "PUIG", "products", key="id")
+    flush_sheets()
+    worksheet = client.open("PUIG").worksheet("products")
+    assert worksheet.get_all_values() == [["id", "name"], ["3", "c"]]
+
+
+def test_sync_grows_the_grid(client):
+    worksheet = client.open("PUIG").worksheet("products")
+    worksheet.row_count = 2
+    worksheet.cells = worksheet.cells[:2]
+    sh_sync(pd.DataFrame({"id": [1, 2, 3], "name": ["a", "b", "c"]}), "PUIG", "products", key="id")
+    flush_sheets()
+    assert worksheet.row_count == 4
+    assert worksheet.get_all_values()[-1] == ["3", "c"]
@@ -0,0 +1,55 @@
+import pytest
+
+import api_data_read_write
+from api_data_read_write import _merge_staging
+
+
+class RecordingConnection:
+    """connection stub keeping the SQL it is asked to run"""
+
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, statement, parameters=None):
+        self.statements.append(str(statement))
+        return self
+
+    rowcount = 0
+
+
+@pytest.fixture
+def connection(monkeypatch):
+    types = {
+        "reference_bike": {"reference": "text", "bike": "text", "row_hash": "text"},
+        "reference_bike__staging": {"reference": "text", "bike": "text"},
+        "variants": {"sku": "text", "title": "text", "row_hash": "text"},
+        "variants__staging": {"sku": "text", "title": "text"},
+    }
+    monkeypatch.setattr(api_data_read_write, "_column_types", lambda connection, table: dict(types[table]))
+    return RecordingConnection()
+
+
+def insert_statement(connection):
+    return next(statement for statement in connection.statements if statement.startswith("INSERT"))
+
+
+def test_table_whose_columns_are_all_keys_does_nothing_on_conflict(connection):
+    _merge_staging(connection, "reference_bike", "reference_bike__staging", ["reference", "bike"])
+    statement = insert_statement(connection)
+    assert statement.endswith('ON CONFLICT ("reference", "bike") DO NOTHING')
+    assert "SET ," not in statement
+
+
+def test_other_columns_are_updated_when_their_hash_changed(connection):
+    _merge_staging(connection, "variants", "variants__staging", ["sku"])
+    statement = insert_statement(connection)
+    assert 'ON CONFLICT ("sku") DO UPDATE SET "title" = EXCLUDED."title", row_hash = EXCLUDED.row_hash' in statement
+    assert statement.endswith('WHERE "variants".row_hash IS DISTINCT FROM EXCLUDED.row_hash')
+
+
+def test_scoped_delete_only_touches_the_parents_present(connection):
+    _merge_staging(connection, "reference_bike", "reference_bike__staging", ["reference", "bike"],
+                   delete_missing="reference")
+    statement = connection.statements[-1]
+    assert statement.startswith('DELETE FROM "reference_bike" t WHERE NOT EXISTS')
+    assert 'AND EXISTS (SELECT 1 FROM "reference_bike__staging" s WHERE CAST(s."reference" AS text) = t."reference")' in statement